@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+""" Micro-benchmarks for the arbitrage search hot paths.
+
+    python bench.py -m test route_plans
+"""
+import argparse
+import sys
+
+from time import perf_counter
+from itertools import product
+
+
+def load_token_graph():
+    import main
+    token_graph = main.TokenGraph(main.__faucet__)
+    main.UniswapV3(token_graph)
+    main.UniswapV2(token_graph)
+    main.Sushiswap(token_graph)
+    main.Balancer(token_graph)
+    main.Curve(token_graph)
+    main.Snowswap(token_graph)
+    main.Mooniswap(token_graph)
+    main.Bancor(token_graph)
+    token_graph._cache_pool_params(main.chain.height, ganache=True)
+    return token_graph
+
+
+def _routes(token_graph):
+    registry = token_graph._registry
+    for circuit in token_graph._get_circuits().values():
+        token_pairs = [registry.token_pairs[edge] for edge in circuit]
+        for pools in product(*[registry.edge_pools(edge) for edge in circuit]):
+            yield list(pools), token_pairs
+
+
+def _rate(quotes: int, secs: float) -> str:
+    return f"{quotes} quotes in {round(secs, 3)} secs ({int(quotes / secs)} quotes/sec)"
+
+
+def route_plans(num_amounts: int=32):
+    """ Quotes per second through each circuit calling pool.get_out_amount versus a compiled RoutePlan.
+    """
+    token_graph = load_token_graph()
+    routes = list(_routes(token_graph))
+    in_amounts = [10**18 * (i + 1) // num_amounts for i in range(num_amounts)]
+    quotes = sum([len(pools) for pools, _ in routes]) * num_amounts
+
+    start = perf_counter()
+    for pools, token_pairs in routes:
+        for in_amount in in_amounts:
+            for pool, token_pair in zip(pools, token_pairs):
+                in_amount = pool.get_out_amount(in_amount, token_pair)
+    print(f"get_out_amount: {_rate(quotes, perf_counter() - start)}")
+
+    start = perf_counter()
+    plans = [token_graph._get_route_plan(pools, token_pairs) for pools, token_pairs in routes]
+    print(f"compiled {len(plans)} route plans in {round(perf_counter() - start, 3)} secs")
+
+    start = perf_counter()
+    for plan in plans:
+        for in_amount in in_amounts:
+            plan.get_out_amount(in_amount)
+    print(f"RoutePlan: {_rate(quotes, perf_counter() - start)}")
+
+
+def constant_product_screen(loan_max: int=1000 * 10**18):
+    """ Time to quote every constant product route on the coarse in_amount grid, and how many routes survive.
+    """
+    token_graph = load_token_graph()
+    circuits = token_graph._get_circuits()
+    start = perf_counter()
+    token_graph._screen_constant_product_routes(circuits, loan_max)
+    print(f"built screen of {len(token_graph._constant_product_screen)} routes in {round(perf_counter() - start, 3)} secs")
+
+    start = perf_counter()
+    survivors = token_graph._screen_constant_product_routes(circuits, loan_max)
+    print(f"screened {len(token_graph._constant_product_screen)} routes in {round(1000 * (perf_counter() - start), 2)} ms, {len(survivors)} survivors")
+
+
+def response_curves(loan_max: int=1000 * 10**18, num_amounts: int=32):
+    """ Quotes per second through routes with expensive pools, exact versus interpolated on this block's response curves.
+    """
+    import main
+    token_graph = load_token_graph()
+    routes = [(pools, token_pairs) for pools, token_pairs in _routes(token_graph) if any([main.is_expensive(pool) for pool in pools])]
+    plans = [token_graph._get_route_plan(pools, token_pairs) for pools, token_pairs in routes]
+    in_amounts = [loan_max * (i + 1) // num_amounts for i in range(num_amounts)]
+    quotes = sum([len(pools) for pools, _ in routes]) * num_amounts
+
+    start = perf_counter()
+    for plan in plans:
+        for in_amount in in_amounts:
+            plan.get_out_amount(in_amount)
+    print(f"exact: {_rate(quotes, perf_counter() - start)}")
+
+    token_graph._response_curves.new_block()
+    start = perf_counter()
+    approx_quoters = [plan.get_approx_quoter(token_graph._response_curves, loan_max) for plan in plans]
+    print(f"sampled {len(token_graph._response_curves)} response curves in {round(perf_counter() - start, 3)} secs")
+
+    start = perf_counter()
+    for get_out_amount in approx_quoters:
+        for in_amount in in_amounts:
+            get_out_amount(in_amount)
+    print(f"response curves: {_rate(quotes, perf_counter() - start)}")
+
+    for plan in plans:
+        for in_amount in in_amounts:
+            plan.verify(token_graph._response_curves, in_amount)
+    print(token_graph._response_curves.report())
+
+
+def balancer_bpow(num_quotes: int=20000):
+    """ Balancer quotes per second through the generic bpow versus the per weight ratio bpow plans, over common pool weights.
+    """
+    import random
+    from dex.balancer import BalancerSwap
+    swap = BalancerSwap()
+    bone = swap._bone
+    random.seed(0)
+    weights = [(1, 1), (4, 1), (1, 4), (7, 3), (3, 7), (49, 1), (1, 49)]
+    bases = [random.randrange(bone // 2, bone) for _ in range(num_quotes)]
+    for weight_in, weight_out in weights:
+        exp = swap.bdiv(weight_in * bone, weight_out * bone)
+        plan = swap.get_plan(weight_in * bone, weight_out * bone)
+
+        start = perf_counter()
+        generic = [swap.bpow(base, exp) for base in bases]
+        generic_secs = perf_counter() - start
+
+        start = perf_counter()
+        planned = [plan.bpow(base) for base in bases]
+        plan_secs = perf_counter() - start
+
+        assert generic == planned
+        print(f"{weight_in}/{weight_out} bpow: {_rate(num_quotes, generic_secs)}, plan: {_rate(num_quotes, plan_secs)}")
+
+
+def uniswapv3_swaps(num_quotes: int=2000, tick_spacing: int=60):
+    """ Exact input v3 swaps per second through a deep synthetic pool, without and with the shared sqrt ratio memo.
+    """
+    import random
+    from dex.uniswapv3 import TickCache, UniswapV3Swap
+    random.seed(0)
+    tick_cache = TickCache(tick_spacing)
+    for word_pos in tick_cache.missing_words(0):
+        tick_cache.set_word(word_pos, 0)
+    # overlapping positions initialize most ticks within the cached words
+    for _ in range(2000):
+        tick_lower = random.randrange(-500, 0) * tick_spacing
+        tick_upper = random.randrange(1, 500) * tick_spacing
+        tick_cache.update_position(tick_lower, tick_upper, random.randrange(10**15, 10**18))
+    liquidity = sum([liquidity_net for tick, liquidity_net in tick_cache.liquidity_net.items() if tick <= 0])
+    state = [UniswapV3Swap().get_sqrt_ratio_at_tick(0), 0, liquidity]
+    in_amounts = [random.randrange(10**18, 10**22) for _ in range(num_quotes)]
+    print(f"{len(tick_cache.liquidity_net)} initialized ticks")
+
+    results = list()
+    for label, swap in [('unmemoized', UniswapV3Swap(memo_size=0)), ('memoized', UniswapV3Swap())]:
+        start = perf_counter()
+        results.append([swap.swap(state, tick_cache, in_amount % 2 == 0, in_amount, 3000) for in_amount in in_amounts])
+        print(f"{label}: {_rate(num_quotes, perf_counter() - start)}")
+    assert results[0] == results[1]
+
+
+def pool_registry(num_walks: int=20):
+    """ Time to walk every circuit's pool combinations and to gather each pool type for the refresh, through per edge sets
+    of addresses and a filtered address dict versus the pool registry's index arrays and per type id lists, and their sizes.
+    """
+    import main
+    import tracemalloc
+    token_graph = load_token_graph()
+    registry = token_graph._registry
+    circuits = list(token_graph._get_circuits().values())
+    pool_types = [main.UniswapV2Pair, main.SushiswapPair, main.UniswapV3Pair, main.MooniswapPool, main.BancorPool, main.BalancerPool,
+                  main.CurvePool, main.SnowswapPool]
+    edges = {edge for circuit in circuits for edge in circuit}
+
+    tracemalloc.start()
+    edge_sets = {edge: {pool.address for pool in registry.edge_pools(edge)} for edge in edges}
+    set_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f"{len(registry)} pools on {len(edges)} edges, address sets: {set_bytes} bytes, "
+          f"index arrays: {registry._edge_offsets.nbytes + registry._edge_pool_ids.nbytes} bytes")
+
+    start = perf_counter()
+    for _ in range(num_walks):
+        for circuit in circuits:
+            for pool_addresses in product(*[edge_sets[edge] for edge in circuit]):
+                [token_graph.address_to_pool[address] for address in pool_addresses]
+        for pool_type in pool_types:
+            [pool for pool in token_graph.address_to_pool.values() if type(pool) is pool_type]
+    print(f"sets and dicts: {round(1000 * (perf_counter() - start) / num_walks, 2)} ms per walk")
+
+    start = perf_counter()
+    for _ in range(num_walks):
+        for circuit in circuits:
+            for pools in product(*[registry.edge_pools(edge) for edge in circuit]):
+                list(pools)
+        for pool_type in pool_types:
+            registry.of_type(pool_type)
+    print(f"pool registry: {round(1000 * (perf_counter() - start) / num_walks, 2)} ms per walk")
+
+
+def pool_memory(num_amounts: int=8):
+    """ Bytes allocated in main.py while loading the full graph, the shallow size of its pool objects, and the peak memory
+    allocated while quoting every route through pool.get_out_amount.
+    """
+    import main
+    import tracemalloc
+    tracemalloc.start()
+    token_graph = load_token_graph()
+    main_stats = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(True, main.__file__)]).statistics('filename')
+    print(f"main.py: {sum([stat.size for stat in main_stats])} bytes in {sum([stat.count for stat in main_stats])} blocks after loading the graph")
+    pools = list(token_graph.address_to_pool.values())
+    pool_bytes = sum([sys.getsizeof(pool) + (sys.getsizeof(pool.__dict__) if hasattr(pool, '__dict__') else 0) for pool in pools])
+    print(f"{len(pools)} pools: {pool_bytes} bytes shallow, {token_graph._registry.counts()}")
+
+    routes = list(_routes(token_graph))
+    in_amounts = [10**18 * (i + 1) // num_amounts for i in range(num_amounts)]
+    quotes = sum([len(pools) for pools, _ in routes]) * num_amounts
+    tracemalloc.reset_peak()
+    traced, _ = tracemalloc.get_traced_memory()
+    start = perf_counter()
+    for pools, token_pairs in routes:
+        for in_amount in in_amounts:
+            for pool, token_pair in zip(pools, token_pairs):
+                in_amount = pool.get_out_amount(in_amount, token_pair)
+    secs = perf_counter() - start
+    print(f"get_out_amount: {_rate(quotes, secs)}, peak {tracemalloc.get_traced_memory()[1] - traced} bytes allocated")
+    tracemalloc.stop()
+
+
+def no_arbitrage(loan_max: int=1000 * 10**18):
+    """ Time to enforce two hop no arbitrage on every weth edge of a two hop circuit through the float64 price gap bisection,
+    versus mpmath's anderson findroot on the marginal prices of the same pool pairs.
+    """
+    import main
+    from fractions import Fraction
+    from itertools import permutations
+    from mpmath import mp
+    token_graph = load_token_graph()
+    registry = token_graph._registry
+    edges = [circuit[0] for circuit in token_graph._get_circuits().values() if len(circuit) == 2]
+
+    slope_errors = dict()
+    for edge in edges:
+        impact_pair = registry.token_pairs[edge][::-1]
+        for pool in registry.edge_pools(edge):
+            if main.has_log_marginal_price(pool):
+                error = main.marginal_slope_error(pool, impact_pair)
+                slope_errors.update({type(pool).__name__: max(slope_errors.get(type(pool).__name__, 0.), error)})
+    print(f"worst marginal price at 0 vs get_out_amount slope: {slope_errors}")
+
+    start = perf_counter()
+    for edge in edges:
+        token_graph._enforce_no_arbitrage(loan_max, edge)
+    print(f"bisection: {len(edges)} edges in {round(1000 * (perf_counter() - start), 2)} ms")
+
+    def to_mpf(price):
+        return mp.mpf(price.numerator) / price.denominator if type(price) is Fraction else price
+
+    start = perf_counter()
+    roots = 0
+    for edge in edges:
+        pools = [pool for pool in registry.edge_pools(edge) if main.is_unipair(pool) or type(pool) is main.BalancerPool]
+        weth, arb_token = registry.token_pairs[edge]
+        impact_pair = (arb_token, weth)
+        for buy_pool, sell_pool in permutations(pools, 2):
+            def gap(x):
+                return to_mpf(buy_pool.marginal_price(int(x), impact_pair)) - to_mpf(sell_pool.marginal_price(-int(x), impact_pair))
+            max_arb = min(buy_pool.get_reserve(arb_token), sell_pool.get_reserve(arb_token))
+            if gap(0) < 0 and gap(max_arb) > 0:
+                try:
+                    mp.findroot(gap, (0, max_arb), tol=1e-18, solver='anderson')
+                    roots += 1
+                except ValueError:
+                    continue
+    print(f"mpmath findroot: {roots} roots on {len(edges)} edges in {round(1000 * (perf_counter() - start), 2)} ms")
+
+
+def in_amounts(num_amounts: int=16):
+    """ Exact output quotes per pool type, each out amount taken from get_out_amount so get_in_amount should give back
+    no more than the in amount that produced it.
+    """
+    token_graph = load_token_graph()
+    registry = token_graph._registry
+    amounts = [10**18 * (i + 1) // num_amounts for i in range(num_amounts)]
+    for pool_type, _ in registry.counts().items():
+        pools = [pool for pool in registry.pools if type(pool).__name__ == pool_type]
+        quotes, misses, secs = 0, 0, 0.
+        for pool in pools:
+            for token_pair in [registry.token_pairs[edge] for edge in range(len(registry.token_pairs))
+                               if pool in registry.edge_pools(edge)]:
+                for in_amount in amounts:
+                    out_amount = pool.get_out_amount(in_amount, token_pair)
+                    start = perf_counter()
+                    exact_in_amount = pool.get_in_amount(out_amount, token_pair)
+                    secs += perf_counter() - start
+                    quotes += 1
+                    misses += exact_in_amount is None or exact_in_amount > in_amount
+        if quotes:
+            print(f"{pool_type} get_in_amount: {_rate(quotes, secs)}, {misses} above the in amount")
+
+
+def bundle_packing(num_candidates: int=300, num_swap_ids: int=600, seed: int=0):
+    """ Time to pick the conflict free arbitrages of a bundle from random candidates of 2 to 4 swaps,
+    with weights spread over the range of weth profits.
+    """
+    import random
+    from bundle_packing import BundlePacker
+    rng = random.Random(seed)
+    weights = [rng.randint(10**15, 10**18) for _ in range(num_candidates)]
+    swap_ids = [set(rng.sample(range(num_swap_ids), rng.randint(2, 4))) for _ in range(num_candidates)]
+    packer = BundlePacker()
+    start = perf_counter()
+    picked = packer.pack(weights, swap_ids)
+    secs = perf_counter() - start
+    print(f"{len(picked)} of {num_candidates} candidates picked in {round(1000 * secs, 2)} ms, {packer.report()}")
+
+def storage_refresh(num_refreshes: int=5):
+    """ Latency of refreshing the full pool set with every pool on eth_call, known storage layouts read by eth_getStorageAt,
+    and uniswap v2 and balancer pools read through PoolStateLens.
+    """
+    import main
+    token_graph = load_token_graph()
+    num_storage_pools = len([pool for pool in token_graph.address_to_pool.values() if pool.reads_storage])
+    print(f"{num_storage_pools} of {len(token_graph.address_to_pool)} pools read storage")
+    for label, read_storage, use_state_lens in [('eth_call', False, False), ('eth_getStorageAt', True, False), ('PoolStateLens', False, True)]:
+        token_graph._read_storage = read_storage
+        token_graph._use_state_lens = use_state_lens
+        start = perf_counter()
+        for _ in range(num_refreshes):
+            token_graph._cache_pool_params(main.chain.height, ganache=True)
+        print(f"{label}: {round(1000 * (perf_counter() - start) / num_refreshes, 2)} ms per refresh")
+
+
+def abi_decoding(num_results: int=20000):
+    """ Decodes per second of static eth_call results through eth_abi versus the compiled decoders batch_request uses.
+    """
+    import random
+    import geth_client
+    from eth_abi import decode_abi
+    from hexbytes import HexBytes
+    random.seed(0)
+    for out_types, index in [(['uint'], -1), (['uint', 'uint', 'uint'], None), (['uint160', 'int24', 'uint16', 'uint16', 'uint16', 'uint8'], None)]:
+        results = ['0x' + ''.join([random.randrange(2**8).to_bytes(32, 'big').hex() for _ in out_types]) for _ in range(num_results)]
+
+        start = perf_counter()
+        generic = list()
+        for result in results:
+            values = decode_abi(out_types, HexBytes(result))
+            generic.append(list(values) if index is None else values[index])
+        generic_secs = perf_counter() - start
+
+        decode = geth_client.get_decoder(out_types, index)
+        start = perf_counter()
+        compiled = [decode(result) for result in results]
+        compiled_secs = perf_counter() - start
+
+        assert generic == compiled
+        print(f"{','.join(out_types)}: decode_abi: {_rate(num_results, generic_secs)}, compiled: {_rate(num_results, compiled_secs)}")
+
+
+def rpc_endpoints(num_batches: int=50):
+    """ p50 and p99 latency of the uniswap v2 reserve refresh batch against the configured rpc endpoints, routed to the least loaded node
+    versus hedged across nodes.
+    """
+    import main
+    import geth_client
+    token_graph = load_token_graph()
+    reserve_requests = [pool.get_param_calls() for pool in token_graph.address_to_pool.values() if main.is_unipair(pool)]
+    for label, critical in [('least loaded', False), ('hedged', True)]:
+        latencies = list()
+        geth_client.reset_rpc_stats()
+        for _ in range(num_batches):
+            start = perf_counter()
+            geth_client.batch_request(reserve_requests, allow_errors=True, critical=critical)
+            latencies.append(perf_counter() - start)
+        latencies.sort()
+        p50, p99 = [round(1000 * latencies[min(int(q * num_batches), num_batches - 1)], 2) for q in (0.5, 0.99)]
+        print(f"{label}: {len(reserve_requests)} calls per batch, p50 {p50} ms, p99 {p99} ms, {geth_client.RPC_STATS['hedged']} hedged")
+    print(geth_client._endpoint_pool.report())
+
+
+def rpc_transports(num_refreshes: int=20):
+    """ p50 and p99 per block refresh latency against the local geth over http versus its ipc socket.
+    """
+    import geth_client
+    token_graph = load_token_graph()
+    endpoint_pool = geth_client._endpoint_pool
+    for label, url in [('http', geth_client._geth_local_host), ('ipc', geth_client._ipc_path)]:
+        geth_client._endpoint_pool = geth_client.EndpointPool([url])
+        latencies = list()
+        for _ in range(num_refreshes):
+            start = perf_counter()
+            token_graph._cache_pool_params(geth_client.latest_block())
+            latencies.append(perf_counter() - start)
+        latencies.sort()
+        p50, p99 = [round(1000 * latencies[min(int(q * num_refreshes), num_refreshes - 1)], 2) for q in (0.5, 0.99)]
+        print(f"{label}: p50 {p50} ms, p99 {p99} ms per refresh")
+    geth_client._endpoint_pool = endpoint_pool
+
+
+if __name__ == "__main__":
+    __bench_parser__ = argparse.ArgumentParser()
+    __bench_parser__.add_argument('-m', '--mode', required=False,
+                                  help='mode passed through to main, benchmarks always run against the ganache fork')
+    __bench_parser__.add_argument('benchmark', help='name of the benchmark to run')
+    __bench_args__ = __bench_parser__.parse_args()
+    getattr(sys.modules[__name__], __bench_args__.benchmark)()
@@ -0,0 +1,57 @@
+pragma solidity =0.8.4;
+pragma experimental ABIEncoderV2;
+
+// Read-only aggregator of pool state for the bot's per-block refresh.
+// Live, its runtime code is injected at an unused address through eth_call state overrides, so it is never deployed on mainnet.
+// On the ganache fork it is deployed and called like any other contract.
+// Pools that revert are left as zero words and flagged false in ok, so the bot can leave them out like a failed eth_call.
+contract PoolStateLens {
+
+    // one word per pair, reserve0 | reserve1 << 112 | blockTimestampLast << 224 as in the pair's reserves slot
+    function uniswapV2Reserves(address[] calldata pairs) external view returns (uint256[] memory words, bool[] memory ok) {
+        words = new uint256[](pairs.length);
+        ok = new bool[](pairs.length);
+        for (uint256 i = 0; i < pairs.length; i++) {
+            try IUniswapV2PairState(pairs[i]).getReserves() returns (uint112 reserve0, uint112 reserve1, uint32 blockTimestampLast) {
+                words[i] = uint256(reserve0) | (uint256(reserve1) << 112) | (uint256(blockTimestampLast) << 224);
+                ok[i] = true;
+            } catch {}
+        }
+    }
+
+    // for each pool, the balance of each of its numTokens[i] tokens then their denormalized weights
+    // tokens holds every pool's tokens concatenated in pool order
+    // ok[i] is false if any of pool i's calls reverted
+    function balancerStates(address[] calldata pools, uint256[] calldata numTokens, address[] calldata tokens) external view returns (uint256[] memory words, bool[] memory ok) {
+        words = new uint256[](2 * tokens.length);
+        ok = new bool[](pools.length);
+        uint256 offset = 0;
+        for (uint256 i = 0; i < pools.length; i++) {
+            IBPoolState pool = IBPoolState(pools[i]);
+            uint256 n = numTokens[i];
+            ok[i] = true;
+            for (uint256 j = 0; j < n; j++) {
+                address token = tokens[offset + j];
+                try pool.getBalance(token) returns (uint256 balance) {
+                    words[2 * offset + j] = balance;
+                } catch {
+                    ok[i] = false;
+                }
+                try pool.getDenormalizedWeight(token) returns (uint256 weight) {
+                    words[2 * offset + n + j] = weight;
+                } catch {
+                    ok[i] = false;
+                }
+            }
+            offset += n;
+        }
+    }
+}
+
+interface IUniswapV2PairState {
+    function getReserves() external view returns (uint112 reserve0, uint112 reserve1, uint32 blockTimestampLast);
+}
+interface IBPoolState {
+    function getBalance(address token) external view returns (uint256);
+    function getDenormalizedWeight(address token) external view returns (uint256);
+}
@@ -10,11 +10,24 @@ contract TestUniswapV3FlashCallback {
         bytes calldata data
     ) external {
 	uint[] memory amount = abi.decode(data,(uint256[]));
-	IERC20(TOKEN_WETH).transfer(msg.sender, amount[0]);
+	IERC20Token(TOKEN_WETH).transfer(msg.sender, amount[0]);
+    }
+
+    function uniswapV3SwapCallback(
+        int256 amount0Delta,
+        int256 amount1Delta,
+        bytes calldata data
+    ) external {
+	address tokenIn = abi.decode(data,(address));
+	IERC20Token(tokenIn).transfer(msg.sender, uint256(amount0Delta > 0 ? amount0Delta : amount1Delta));
     }
 
     function testFlash(address pool, uint amount, bool isToken0, bytes memory data) public { 
-	IUniswapV3PoolActions(pool).flash(address(this), amount ? isToken0 : 0, amount ? isToken0 : 0, data);
+	IUniswapV3PoolActions(pool).flash(address(this), isToken0 ? amount : 0, isToken0 ? 0 : amount, data);
+    }
+
+    function testSwap(address pool, bool zeroForOne, int256 amountSpecified, uint160 sqrtPriceLimitX96, address tokenIn) public {
+	IUniswapV3PoolActions(pool).swap(msg.sender, zeroForOne, amountSpecified, sqrtPriceLimitX96, abi.encode(tokenIn));
     }
 }
 
@@ -25,6 +38,13 @@ interface IUniswapV3PoolActions {
         uint256 amount1,
         bytes calldata data
     ) external;
+    function swap(
+        address recipient,
+        bool zeroForOne,
+        int256 amountSpecified,
+        uint160 sqrtPriceLimitX96,
+        bytes calldata data
+    ) external returns (int256 amount0, int256 amount1);
 }
 interface IERC20Token {
     function transfer(address _to, uint256 _value) external returns (bool success);
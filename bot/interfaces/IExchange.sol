@@ -11,6 +11,8 @@ interface IExchange {
     function swapExactAmountIn(address tokenIn, uint tokenAmountIn, address tokenOut, uint minAmountOut, uint maxPrice) external returns (uint tokenAmountOut, uint spotPriceAfter);
     /* mooniswap */
     function swap(address src, address dst, uint256 amount, uint256 minReturn, address referral) external payable returns (uint256 result);
+    /* bancor */
+    function convertByPath(address[] calldata _path, uint256 _amount, uint256 _minReturn, address _beneficiary, address _affiliateAccount, uint256 _affiliateFee) external payable returns (uint256);
     /* hiding book */
     struct RfqOrder {
         address makerToken;
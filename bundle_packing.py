@@ -0,0 +1,109 @@
+from typing import Hashable, List, Set
+
+
+class BundlePacker:
+    """ Picks the arbitrages of a bundle as a maximum weight set packing: no two picked arbitrages swap on the same pool and pair.
+    Arbitrages only conflict within connected components of the conflict graph, so each component is solved on its own,
+    exactly by branch and bound up to max_exact arbitrages and by greedy selection with swap improvements beyond that.
+    """
+
+    def __init__(self, max_exact: int=20):
+        self._max_exact = max_exact
+        self._stats = (0, 0, 0)     # candidates, components, components solved greedily in the last pack
+
+    def conflicts(self, swap_ids: List[Set[Hashable]]) -> List[int]:
+        """ Bitmask of the candidates each candidate shares a swap id with.
+        """
+        masks = [0] * len(swap_ids)
+        sharing = dict()
+        for i, ids in enumerate(swap_ids):
+            for swap_id in ids:
+                sharing[swap_id] = sharing.get(swap_id, 0) | (1 << i)
+        for i, ids in enumerate(swap_ids):
+            for swap_id in ids:
+                masks[i] |= sharing[swap_id]
+            masks[i] &= ~(1 << i)
+        return masks
+
+    def pack(self, weights: List[int], swap_ids: List[Set[Hashable]]) -> List[int]:
+        """ Indices of the conflict free candidates with the largest total weight, heaviest first.
+        Candidates without positive weight are never picked.
+        """
+        masks = self.conflicts(swap_ids)
+        picked = list()
+        seen = 0
+        num_components, num_greedy = 0, 0
+        for i in range(len(weights)):
+            if seen >> i & 1 or weights[i] <= 0:
+                continue
+            component, frontier = 0, 1 << i
+            while frontier:
+                component |= frontier
+                neighbours = 0
+                for j in _bits(frontier):
+                    neighbours |= masks[j]
+                frontier = neighbours & ~component
+            seen |= component
+            members = [j for j in _bits(component) if weights[j] > 0]
+            num_components += 1
+            if len(members) <= self._max_exact:
+                picked += self._pack_exact(members, weights, masks)
+            else:
+                num_greedy += 1
+                picked += self._pack_greedy(members, weights, masks)
+        self._stats = (len(weights), num_components, num_greedy)
+        return sorted(picked, key=lambda i: -weights[i])
+
+    @staticmethod
+    def _pack_exact(members: List[int], weights: List[int], masks: List[int]) -> List[int]:
+        # depth first over members heaviest first, pruned once the picked weight plus every open member can't beat the best
+        members = sorted(members, key=lambda i: -weights[i])
+        suffix = [0] * (len(members) + 1)
+        for k in range(len(members) - 1, -1, -1):
+            suffix[k] = suffix[k + 1] + weights[members[k]]
+        best_weight, best = 0, list()
+        stack = [(0, 0, 0, list())]      # next member, picked weight, mask of blocked candidates, picked candidates
+        while stack:
+            k, weight, blocked, chosen = stack.pop()
+            if weight > best_weight:
+                best_weight, best = weight, chosen
+            if k == len(members) or weight + suffix[k] <= best_weight:
+                continue
+            i = members[k]
+            stack.append((k + 1, weight, blocked, chosen))
+            if not blocked >> i & 1:
+                stack.append((k + 1, weight + weights[i], blocked | masks[i], chosen + [i]))
+        return best
+
+    @staticmethod
+    def _pack_greedy(members: List[int], weights: List[int], masks: List[int]) -> List[int]:
+        # heaviest first, then swap in any candidate outweighing the picked candidates it conflicts with until none does
+        picked = 0
+        for i in sorted(members, key=lambda i: -weights[i]):
+            if not masks[i] & picked:
+                picked |= 1 << i
+        improved = True
+        while improved:
+            improved = False
+            for i in members:
+                if picked >> i & 1:
+                    continue
+                displaced = masks[i] & picked
+                if weights[i] > sum([weights[j] for j in _bits(displaced)]):
+                    picked = (picked & ~displaced) | (1 << i)
+                    improved = True
+        return list(_bits(picked))
+
+    def report(self) -> str:
+        num_candidates, num_components, num_greedy = self._stats
+        return f"bundle packing: {num_candidates} candidates in {num_components} conflict components, {num_greedy} packed greedily"
+
+
+def _bits(mask: int):
+    """ Indices of the set bits of mask, lowest first.
+    """
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
@@ -4,6 +4,21 @@ from typing import Tuple, List, Optional
 class BalancerSwap:
     _bone = 10**18
     _max_in_ratio = _bone // 2
+    _max_plans = 4096         # weights of smart pools drift every block, so the plan cache is cleared when it grows past this
+
+    def __init__(self):
+        self._plans = dict()  # (weight in, weight out) -> BPowPlan
+
+    def get_plan(self, weight_in: int, weight_out: int) -> 'BPowPlan':
+        """ bpow plan of the weight ratio between two tokens, shared by every pool with the same weights.
+        """
+        plan = self._plans.get((weight_in, weight_out))
+        if plan is None:
+            if len(self._plans) >= self._max_plans:
+                self._plans.clear()
+            plan = BPowPlan(self, self.bdiv(weight_in, weight_out))
+            self._plans.update({(weight_in, weight_out): plan})
+        return plan
 
     def badd(self, a: int, b: int) -> int:
         c = a + b
@@ -96,10 +111,10 @@ class BalancerSwap:
         max_out = self.bmul(bO, 2 * self._bone - 1)
         if out_amount > max_out:
             return None
-        weightRatio = self.bdiv(wI, wO)
+        plan = self.get_plan(wI, wO)
         diff = self.bsub(bO, out_amount)
         y = self.bdiv(bO, diff)
-        foo = self.bpow(y, weightRatio)
+        foo = plan.bpow(y)
         foo = self.bsub(foo, self._bone)
         in_amount = self.bsub(self._bone, swap_fee)
         in_amount = self.bdiv(self.bmul(bI, foo), in_amount)
@@ -113,11 +128,11 @@ class BalancerSwap:
         max_in = self.bmul(bI, self._bone // 2)
         if in_amount > max_in or in_amount <= 222:  # prevent ERR_MATH_APPROX when in_amount == macheps
             return 0
-        weight_ratio = self.bdiv(wI, wO)
+        plan = self.get_plan(wI, wO)
         adjusted_in = self.bsub(self._bone, swap_fee)
         adjusted_in = self.bmul(in_amount, adjusted_in)
         y = self.bdiv(bI, self.badd(bI, adjusted_in))
-        foo = self.bpow(y, weight_ratio)
+        foo = plan.bpow(y)
         bar = self.bsub(self._bone, foo)
         token_amount_out = self.bmul(bO, bar)
         spot_price_after = self.spot_price(bI + in_amount, wI, bO - token_amount_out, wO, swap_fee)
@@ -125,3 +140,73 @@ class BalancerSwap:
             return 0
         else:
             return token_amount_out
+
+
+class BPowPlan:
+    """ BalancerSwap.bpow with the exponent fixed, e.g. a pool's weight ratio.
+    exp is split into its whole and fractional parts once, and the (c, cneg, bigK) coefficients of the bpowApprox series are memoized
+    as they are first needed. Every bmul and bdiv rounds exactly as in BNum.sol, so results are bit-identical to bpow.
+    """
+
+    def __init__(self, swap: BalancerSwap, exp: int):
+        bone = swap._bone
+        self._swap = swap
+        self._bone = bone
+        self._half_bone = bone // 2
+        self._precision = bone // 10**10
+        self.exp = exp
+        self.whole = exp // bone
+        self.remain = exp - self.whole * bone
+        self._series = list()   # (c, cneg, bigK, bigK // 2) of each term of bpowApprox
+
+    def _extend_series(self):
+        bigK = (len(self._series) + 1) * self._bone
+        c, cneg = self._swap.bsubSign(self.remain, bigK - self._bone)
+        self._series.append((c, cneg, bigK, bigK // 2))
+
+    def bpow_approx(self, base: int) -> int:
+        """ bpowApprox(base, self.remain, bone // 10**10) with bmul and bdiv inlined.
+        """
+        bone = self._bone
+        half_bone = self._half_bone
+        precision = self._precision
+        series = self._series
+        x, xneg = self._swap.bsubSign(base, bone)
+        term = bone
+        _sum = term
+        negative = False
+        i = 0
+        while term >= precision:
+            if i == len(series):
+                self._extend_series()
+            c, cneg, bigK, half_bigK = series[i]
+            term = (term * ((c * x + half_bone) // bone) + half_bone) // bone
+            term = (term * bone + half_bigK) // bigK
+            if term == 0:
+                break
+
+            if xneg:
+                negative = not negative
+            if cneg:
+                negative = not negative
+            if negative:
+                assert _sum >= term
+                _sum -= term
+            else:
+                _sum += term
+
+            i += 1
+
+        return _sum
+
+    def bpow(self, base: int) -> int:
+        assert base >= 1
+        assert base <= (2 * self._bone) - 1
+        if self.remain == 0:
+            return self._swap.bpowi(base, self.whole)
+        partial_result = self.bpow_approx(base)
+        if self.whole == 0:
+            # bmul(bone, partial_result) == partial_result
+            return partial_result
+
+        return self._swap.bmul(self._swap.bpowi(base, self.whole), partial_result)
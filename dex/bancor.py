@@ -1,13 +1,23 @@
-from typing import List, Optional
+from bisect import bisect_left
+from math import gcd
+from typing import List, Optional, Tuple
 
 
 class BancorConversionPath:
+    """ crossReserveTargetAmount and power in BancorFormula.sol
+    """
     _max_num = 0x200000000000000000000000000000000
     _fixed_1 = 0x080000000000000000000000000000000
     _opt_log_max_val = 0x15bf0a8b1457695355fb8ac404e7a79e3
+    _opt_exp_max_val = 0x800000000000000000000000000000000
+    _ln2_numerator = 0x3f80fe03f80fe03f80fe03f80fe03f8
+    _ln2_denominator = 0x5b9de1d10bf4103d647b0955897ba80
+    _min_precision = 32
     _max_precision = 127
     _fixed_2 = 0x100000000000000000000000000000000
     _one = 1
+    _max_weight = 1000000
+    _ppm_resolution = 1000000
     _max_exp_arr = [0] * 32 + [
         0x1c35fedd14ffffffffffffffffffffffff,
         0x1b0ce43b323fffffffffffffffffffffff,
@@ -106,6 +116,8 @@ class BancorConversionPath:
         0x008b380f3558668c46c91c49a2f8e967b9,
         0x00857ddf0117efa215952912839f6473e6,
     ]
+    # _max_exp_arr[_min_precision:] is decreasing, so reversed it can be binary searched with bisect
+    _max_exp_ascending = _max_exp_arr[:_min_precision - 1:-1]
 
     def optimal_log(self, x: int) -> int:
         res, y, z, w = [0] * 4
@@ -327,7 +339,15 @@ class BancorConversionPath:
 
         return res // 0x688589cc0e9505e2f2fee5580000000 + _x + (self._one << _precision)
 
-    def power(self, base_n: int, base_d: int, exp_n: int, exp_d: int) -> Optional[int]:
+    def find_pos_in_max_exp_array(self, x: int) -> Optional[int]:
+        """ Highest precision whose _max_exp_arr entry is at least x, None where findPositionInMaxExpArray reverts.
+        """
+        i = bisect_left(self._max_exp_ascending, x)
+        if i == len(self._max_exp_ascending):
+            return None
+        return self._max_precision - i
+
+    def power(self, base_n: int, base_d: int, exp_n: int, exp_d: int) -> Optional[Tuple[int, int]]:
         if base_n >= self._max_num:
             return None
         base = (base_n * self._fixed_1) // base_d
@@ -336,20 +356,46 @@ class BancorConversionPath:
         else:
             base_log = self.general_log(base)
         base_log_times_exp = (base_log * exp_n) // exp_d
-        if base_log_times_exp < self._opt_log_max_val:
-            return self.optimial_exp(base_log_times_exp), self._max_precision
+        if base_log_times_exp < self._opt_exp_max_val:
+            return self.optimal_exp(base_log_times_exp), self._max_precision
         else:
             precision = self.find_pos_in_max_exp_array(base_log_times_exp)
+            if precision is None:
+                return None
             return self.general_exp(base_log_times_exp >> (self._max_precision - precision), precision), precision
 
-    def convert(self, in_amount: int, params: List[int]) -> int:
+    def get_exponent(self, in_weight: int, out_weight: int) -> Tuple[int, int]:
+        """ in_weight / out_weight in lowest terms. power floors base_log * exp_n / exp_d, so the reduced exponent gives the same result
+        with smaller multiplies.
+        """
+        divisor = gcd(in_weight, out_weight) or 1
+        return in_weight // divisor, out_weight // divisor
+
+    def convert(self, in_amount: int, params: List[int], exponent: Optional[Tuple[int, int]]=None) -> int:
+        """ Target amount before the conversion fee, 0 where the converter would revert.
+        """
         in_reserve, in_weight, out_reserve, out_weight = params
+        if in_reserve <= 0 or out_reserve <= 0 or in_amount <= 0:
+            return 0
         if in_weight <= 0 or in_weight > self._max_weight or out_weight <= 0 or out_weight > self._max_weight:
             return 0
         if in_weight == out_weight:
             return (out_reserve * in_amount) // (in_reserve + in_amount)
+        exp_n, exp_d = exponent if exponent is not None else (in_weight, out_weight)
         base_n = in_reserve + in_amount
-        result, precision = self.power(base_n, in_reserve, in_weight, out_weight)
+        power = self.power(base_n, in_reserve, exp_n, exp_d)
+        if power is None:
+            return 0
+        result, precision = power
         temp1 = out_reserve * result
         temp2 = out_reserve << precision
         return (temp1 - temp2) // result
+
+    def deduct_fee(self, amount: int, conversion_fee: int, legacy: bool=False) -> int:
+        """ Target amount after the conversion fee, rounded as LiquidityPoolV1Converter or, for converters older than v28,
+        getFinalAmount(amount, 2), which charges the fee once per reserve of a cross reserve conversion.
+        """
+        if legacy:
+            ppm = self._ppm_resolution
+            return amount * (ppm - conversion_fee) ** 2 // ppm ** 2
+        return amount - amount * conversion_fee // self._ppm_resolution
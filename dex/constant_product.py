@@ -0,0 +1,78 @@
+import numpy
+
+from typing import Dict, Hashable, List, Tuple
+
+
+def get_out_amounts(in_reserves: numpy.ndarray, out_reserves: numpy.ndarray, fees: numpy.ndarray, in_amounts: numpy.ndarray) -> numpy.ndarray:
+    """ Float64 out amounts of constant product pools, broadcast over reserves, fees and in_amounts.
+    fees are the fraction of in_amount that reaches the reserves, e.g. 0.997 on uniswap.
+    """
+    in_amounts_with_fee = fees * in_amounts
+    return out_reserves * in_amounts_with_fee / (in_reserves + in_amounts_with_fee)
+
+
+class ConstantProductScreen:
+    """ Constant product routes packed into arrays of (pool, direction) slots, so a whole layer of the search is quoted at once.
+    Quotes are float64 and only screen routes: survivors still need exact integer quotes.
+    """
+
+    _tolerance = 1e-9         # relative float64 error allowed before a route is screened out
+
+    def __init__(self):
+        self._slots = dict()
+        self._route_keys = dict()
+        self._route_slots = dict()
+        self._in_reserves = numpy.zeros(0)
+        self._out_reserves = numpy.zeros(0)
+        self._fees = numpy.zeros(0)
+
+    def __len__(self) -> int:
+        return sum([len(keys) for keys in self._route_keys.values()])
+
+    @property
+    def slots(self) -> List[Hashable]:
+        return list(self._slots.keys())
+
+    def add_route(self, key: Hashable, slot_keys: List[Hashable]):
+        """ Register a route as the ordered (pool, token pair) slots it swaps through.
+        """
+        slots = [self._slots.setdefault(slot_key, len(self._slots)) for slot_key in slot_keys]
+        num_hops = len(slots)
+        self._route_keys.setdefault(num_hops, list()).append(key)
+        self._route_slots.setdefault(num_hops, list()).append(slots)
+
+    def set_reserves(self, reserves: List[Tuple[int, int, float]]):
+        """ Set (in_reserve, out_reserve, fee) for every slot, in the order of self.slots.
+        """
+        in_reserves, out_reserves, fees = zip(*reserves) if reserves else ((), (), ())
+        self._in_reserves = numpy.array(in_reserves, dtype=numpy.float64)
+        self._out_reserves = numpy.array(out_reserves, dtype=numpy.float64)
+        self._fees = numpy.array(fees, dtype=numpy.float64)
+        # empty pools quote zero instead of dividing by zero
+        empty = (self._in_reserves == 0) | (self._out_reserves == 0)
+        self._in_reserves[empty] = 1
+        self._out_reserves[empty] = 0
+
+    def screen(self, in_amounts: numpy.ndarray) -> Dict[Hashable, int]:
+        """ Quote every route at every in_amount and return the best in_amount of each route that may be profitable.
+        """
+        in_amounts = numpy.asarray(in_amounts, dtype=numpy.float64)
+        survivors = dict()
+        if len(in_amounts) == 0:
+            return survivors
+        for num_hops, keys in self._route_keys.items():
+            slots = numpy.array(self._route_slots[num_hops], dtype=numpy.intp)
+            out_amounts = numpy.broadcast_to(in_amounts, (len(keys), len(in_amounts)))
+            for hop in range(num_hops):
+                hop_slots = slots[:, hop, None]
+                out_amounts = get_out_amounts(self._in_reserves[hop_slots],
+                                              self._out_reserves[hop_slots],
+                                              self._fees[hop_slots],
+                                              out_amounts)
+            profits = out_amounts - in_amounts
+            best = numpy.argmax(profits, axis=1)
+            best_profits = profits[numpy.arange(len(keys)), best]
+            for i in numpy.nonzero(best_profits > -self._tolerance * in_amounts[best])[0]:
+                survivors.update({keys[i]: int(in_amounts[best[i]])})
+
+        return survivors
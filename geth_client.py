@@ -1,20 +1,24 @@
 import asyncio
 import sys
+import bisect
+import threading
 import requests
 import json
+import codecs
 import configparser
-from aiohttp import ClientSession
-from time import sleep
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector
+from time import sleep, perf_counter, monotonic
+from collections import deque
 
 # typing
 from web3.eth import Contract, TxParams
-from typing import List, Tuple, Union, Optional
+from typing import Callable, Dict, List, Tuple, Union, Optional
 from eth_typing import ChecksumAddress, HexAddress, BlockNumber, HexStr
 
 from web3 import Web3
 from web3.exceptions import MismatchedABI
 from web3.providers.base import JSONBaseProvider
-from web3.providers import HTTPProvider, WebsocketProvider
+from web3.providers import HTTPProvider, IPCProvider, WebsocketProvider
 
 from eth_abi import decode_abi
 from eth_abi.exceptions import InsufficientDataBytes
@@ -30,7 +34,9 @@ _web_socket = CONFIG['ws']
 _ws_provider = WebsocketProvider(_web_socket)
 _ws_geth_client = Web3(_ws_provider)
 _geth_local_host = CONFIG['http']
-_http_provider = HTTPProvider(_geth_local_host)
+TRANSPORT = CONFIG.get('transport', fallback='http')      # 'ipc' talks to the local geth over its unix socket instead of http
+_ipc_path = CONFIG.get('ipc', fallback=None)
+_http_provider = IPCProvider(_ipc_path) if TRANSPORT == 'ipc' else HTTPProvider(_geth_local_host)
 _http_geth_client = Web3(_http_provider)
 _ganache_local_host = CONFIG['ganache']
 _ganache_provider = HTTPProvider(_ganache_local_host)
@@ -43,6 +49,14 @@ _etherscan_apikey = CONFIG['etherscan_apikey']
 _etherscan_url = 'https://api.etherscan.io/api'
 SESSION = requests.Session()
 BOT = CONFIG['bot']
+STATE_LENS = CONFIG.getboolean('state_lens', fallback=False)
+RPC_TIMEOUT = CONFIG.getfloat('rpc_timeout', fallback=10.)   # seconds per attempt of a batched request
+RPC_RETRIES = 3                                                # retries of transient failures, backing off exponentially
+RPC_BACKOFF = 0.1                                              # seconds before the first retry
+RPC_ENDPOINTS = [_ipc_path if TRANSPORT == 'ipc' and name.strip() == 'http' else CONFIG[name.strip()]
+                 for name in CONFIG.get('rpc_endpoints', fallback='http').split(',')]
+HEDGE_PERCENTILE = CONFIG.getfloat('hedge_percentile', fallback=0.95)  # critical calls are duplicated once slower than this
+_transient_errors = ['header not found', 'timeout', 'timed out', 'too many', 'busy', 'limit exceeded']
 
 
 def rebind():
@@ -87,25 +101,338 @@ def wait_for_sync():
         sleep(1)
 
 
-async def async_make_request(session: ClientSession, rpc_endpoint: str, method: str, params: list, _id: int):
-    base_provider = JSONBaseProvider()
-    request_data = base_provider.encode_rpc_request(method, params)
-    async with session.post(rpc_endpoint,
-                            data=request_data,
-                            headers={'Content-Type': 'application/json'}) as response:
-        content = await response.read()
-    response = base_provider.decode_rpc_response(content)
+class CallError(ValueError):
+    """ A call in a batch that failed, returned in place of its result when the batch allows errors.
+    """
+
+    def __init__(self, request: Union[list, dict], error: Union[dict, str]):
+        super().__init__(f"{error} on request {request}")
+        self.request = request
+        self.error = error
+
+
+def is_transient(error: dict) -> bool:
+    """ Whether a JSON-RPC error is the node being overloaded or behind, rather than the call reverting.
+    """
+    message = str(error.get('message', '')).lower()
+    return any([transient in message for transient in _transient_errors])
+
+
+class Endpoint:
+    """ An rpc node with its recent latencies, requests in flight and health.
+    Consecutive failures take it out of rotation for a cooldown that doubles with every further failure.
+    """
+
+    _window = 256               # latencies kept
+    _max_failures = 3           # consecutive failures before the node is benched
+    _cooldown = 5.              # seconds benched after _max_failures
+    _default_delay = 0.05       # hedge delay in secs until enough latencies are known
+
+    def __init__(self, url: str):
+        self.url = url
+        self.in_flight = 0
+        self._latencies = deque(maxlen=self._window)
+        self._sorted_latencies = list()
+        self._failures = 0
+        self._benched_until = 0.
+
+    @property
+    def healthy(self) -> bool:
+        return monotonic() >= self._benched_until
+
+    def record(self, secs: float, ok: bool):
+        if ok:
+            if len(self._latencies) == self._window:
+                del self._sorted_latencies[bisect.bisect_left(self._sorted_latencies, self._latencies[0])]
+            self._latencies.append(secs)
+            bisect.insort(self._sorted_latencies, secs)
+            self._failures = 0
+        else:
+            self._failures += 1
+            if self._failures >= self._max_failures:
+                self._benched_until = monotonic() + self._cooldown * 2 ** (self._failures - self._max_failures)
+
+    def percentile(self, q: float) -> float:
+        latencies = self._sorted_latencies
+        if len(latencies) < 20:
+            return self._default_delay
+        return latencies[min(int(q * len(latencies)), len(latencies) - 1)]
+
+    def report(self) -> str:
+        return f"{self.url}: p50 {round(1000 * self.percentile(0.5), 1)} ms, p99 {round(1000 * self.percentile(0.99), 1)} ms, " \
+               f"{'healthy' if self.healthy else 'benched'}"
+
+    async def send(self, session: ClientSession, method: str, params: list) -> dict:
+        base_provider = JSONBaseProvider()
+        async with session.post(self.url,
+                                data=base_provider.encode_rpc_request(method, params),
+                                headers={'Content-Type': 'application/json'}) as response:
+            content = await response.read()
+        return base_provider.decode_rpc_response(content)
+
+
+class IPCConnection:
+    """ A persistent unix socket to geth. Requests are written back to back without waiting for responses,
+    which are read as a stream of JSON objects and matched to their requests by id.
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._writer = None
+        self._pending = dict()          # id -> future of the response
+        self._next_id = 0
+        self._connecting = asyncio.Lock()
+
+    async def _connect(self):
+        async with self._connecting:
+            if self._writer is None:
+                reader, writer = await asyncio.open_unix_connection(self._path)
+                asyncio.ensure_future(self._read_responses(reader, writer))
+                self._writer = writer
+
+    async def _read_responses(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        decoder = json.JSONDecoder()
+        utf8 = codecs.getincrementaldecoder('utf-8')()     # keeps characters split across reads until their last byte arrives
+        buffer = ''
+        try:
+            while True:
+                chunk = await reader.read(2**16)
+                if not chunk:
+                    raise ConnectionResetError(f"ipc socket {self._path} closed")
+                buffer += utf8.decode(chunk)
+                while True:
+                    buffer = buffer.lstrip()
+                    try:
+                        response, end = decoder.raw_decode(buffer)
+                    except json.JSONDecodeError:
+                        break
+                    buffer = buffer[end:]
+                    if type(response) is not dict:
+                        raise ConnectionResetError(f"ipc socket {self._path} sent a non object response {response}")
+                    future = self._pending.pop(response.get('id'), None)
+                    if future is not None and not future.done():
+                        future.set_result(response)
+        except Exception as e:
+            # every request in flight on this socket fails, the next request reconnects
+            error = e if isinstance(e, OSError) else ConnectionResetError(f"ipc socket {self._path} reader failed: {e!r}")
+            if self._writer is writer:
+                self._writer = None
+            writer.close()
+            pending, self._pending = self._pending, dict()
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(error)
+
+    async def request(self, method: str, params: list) -> dict:
+        if self._writer is None:
+            await self._connect()
+        _id = self._next_id
+        self._next_id += 1
+        future = asyncio.get_event_loop().create_future()
+        self._pending.update({_id: future})
+        self._writer.write(json.dumps({'jsonrpc': '2.0', 'method': method, 'params': params, 'id': _id}).encode())
+        return await future
+
+
+class IPCEndpoint(Endpoint):
+    """ The local geth over its ipc socket, one persistent pipelined connection per event loop.
+    """
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self._connections = dict()      # event loop -> IPCConnection
+
+    async def send(self, session: ClientSession, method: str, params: list) -> dict:
+        loop = asyncio.get_event_loop()
+        if loop not in self._connections:
+            self._connections.update({loop: IPCConnection(self.url)})
+        return await asyncio.wait_for(self._connections[loop].request(method, params), RPC_TIMEOUT)
+
+
+def make_endpoint(url: str) -> Endpoint:
+    # the configured ipc path is a socket whatever its name, every other url is http
+    return IPCEndpoint(url) if _ipc_path is not None and url == _ipc_path else Endpoint(url)
+
+
+class ConcurrencyLimiter:
+    """ AIMD limit on the requests in flight to a set of nodes. The limit grows by one for every limit's worth of requests
+    answered within tolerance of the fastest recent latency and halves, at most once per target latency, on errors or slower answers.
+    Critical requests are admitted ahead of waiting background ones, and background requests are held to a share of the limit
+    so the hot path always finds room. Shared by the event loops of every thread.
+    """
+
+    _latency_tolerance = 3.         # answers slower than this multiple of the baseline latency count as congestion
+    _latency_slack = 0.002          # secs added to the target so tiny baselines don't read noise as congestion
+
+    def __init__(self, initial_limit: int=64, min_limit: int=4, max_limit: int=1024, background_share: float=0.5):
+        self.limit = float(initial_limit)
+        self._min_limit = min_limit
+        self._max_limit = max_limit
+        self._background_share = background_share
+        self.in_flight = {True: 0, False: 0}            # critical -> requests in flight
+        self._waiters = {True: deque(), False: deque()}  # critical -> (event loop, future) waiting for a slot
+        self._baseline = None
+        self._last_decrease = 0.
+        self._lock = threading.Lock()
+
+    def _admissible(self, critical: bool) -> bool:
+        if sum(self.in_flight.values()) >= int(self.limit):
+            return False
+        if critical:
+            return True
+        return len(self._waiters[True]) == 0 and self.in_flight[False] < max(1, int(self.limit * self._background_share))
+
+    async def acquire(self, critical: bool):
+        with self._lock:
+            if len(self._waiters[critical]) == 0 and self._admissible(critical):
+                self.in_flight[critical] += 1
+                return
+            loop = asyncio.get_event_loop()
+            future = loop.create_future()
+            self._waiters[critical].append((loop, future))
+        # the slot is counted in flight by the release that grants it
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(critical)
+            raise
+
+    def release(self, critical: bool, secs: Optional[float]=None, ok: bool=True):
+        with self._lock:
+            self.in_flight[critical] -= 1
+            if secs is not None:
+                self._adjust(secs, ok)
+            for waiting_class in (True, False):
+                waiters = self._waiters[waiting_class]
+                while len(waiters) != 0 and self._admissible(waiting_class):
+                    loop, future = waiters.popleft()
+                    self.in_flight[waiting_class] += 1
+                    loop.call_soon_threadsafe(self._grant, future, waiting_class)
+
+    def _grant(self, future: asyncio.Future, critical: bool):
+        if future.cancelled():
+            self.release(critical)
+        else:
+            future.set_result(None)
+
+    def _adjust(self, secs: float, ok: bool):
+        baseline = self._baseline
+        # the baseline drops to any faster answer and drifts slowly up towards slower ones
+        self._baseline = secs if baseline is None or secs < baseline else baseline + 0.01 * (secs - baseline)
+        target = self._latency_tolerance * self._baseline + self._latency_slack
+        if ok and secs <= target:
+            self.limit = min(self.limit + 1 / self.limit, self._max_limit)
+        elif monotonic() - self._last_decrease > target:
+            self.limit = max(self.limit / 2, self._min_limit)
+            self._last_decrease = monotonic()
+
+    def report(self) -> str:
+        return f"limit {int(self.limit)}, {self.in_flight[True]} critical and {self.in_flight[False]} background in flight"
+
+
+class EndpointPool:
+    """ Rpc nodes serving the same chain. Critical calls go to the fastest node and are hedged to the next fastest
+    once slower than its HEDGE_PERCENTILE latency, bulk calls go to the node with the fewest requests in flight.
+    Every request waits for a slot from the pool's ConcurrencyLimiter.
+    """
+
+    def __init__(self, urls: List[str]):
+        self.endpoints = [make_endpoint(url) for url in urls]
+        self.limiter = ConcurrencyLimiter()
+
+    async def post(self, session: ClientSession, endpoint: Endpoint, method: str, params: list, critical: bool=False) -> dict:
+        await self.limiter.acquire(critical)
+        endpoint.in_flight += 1
+        start = perf_counter()
+        try:
+            response = await endpoint.send(session, method, params)
+            ok = 'error' not in response.keys() or not is_transient(response['error'])
+        except (asyncio.TimeoutError, ClientError, OSError, ValueError) as e:
+            response = {'error': {'message': f"{type(e).__name__}: {e}"}}
+            ok = False
+        except asyncio.CancelledError:
+            # cancelled hedges free their slot without counting as a latency sample
+            endpoint.in_flight -= 1
+            self.limiter.release(critical)
+            raise
+        secs = perf_counter() - start
+        endpoint.in_flight -= 1
+        self.limiter.release(critical, secs, ok)
+        endpoint.record(secs, ok)
+        return response
+
+    def _candidates(self) -> List[Endpoint]:
+        healthy = [endpoint for endpoint in self.endpoints if endpoint.healthy]
+        return healthy if healthy != list() else self.endpoints
+
+    def ranked(self) -> List[Endpoint]:
+        return sorted(self._candidates(), key=lambda endpoint: endpoint.percentile(0.5))
+
+    def least_loaded(self) -> Endpoint:
+        return min(self._candidates(), key=lambda endpoint: (endpoint.in_flight, endpoint.percentile(0.5)))
+
+    async def hedged(self, session: ClientSession, method: str, params: list) -> dict:
+        endpoints = self.ranked()
+        first = asyncio.ensure_future(self.post(session, endpoints[0], method, params, critical=True))
+        if len(endpoints) == 1:
+            return await first
+        done, _ = await asyncio.wait({first}, timeout=endpoints[0].percentile(HEDGE_PERCENTILE))
+        if done:
+            return first.result()
+        RPC_STATS['hedged'] += 1
+        pending = {first, asyncio.ensure_future(self.post(session, endpoints[1], method, params, critical=True))}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            response = done.pop().result()
+            if 'error' not in response.keys() or not pending:
+                for task in pending:
+                    task.cancel()
+                return response
+
+    def report(self) -> str:
+        return ', '.join([endpoint.report() for endpoint in self.endpoints] + [self.limiter.report()])
+
+
+_endpoint_pool = EndpointPool(RPC_ENDPOINTS)
+_ganache_pool = EndpointPool([_ganache_local_host])
+
+
+async def async_make_request(session: ClientSession, endpoint_pool: EndpointPool, method: str, params: list, _id: int, critical: bool=False):
+    for attempt in range(RPC_RETRIES + 1):
+        if critical:
+            response = await endpoint_pool.hedged(session, method, params)
+        else:
+            response = await endpoint_pool.post(session, endpoint_pool.least_loaded(), method, params)
+        if 'error' not in response.keys() or not is_transient(response['error']):
+            break
+        if attempt < RPC_RETRIES:
+            await asyncio.sleep(RPC_BACKOFF * 2 ** attempt)
     response['id'] = _id
 
     return response
 
 
-async def run_batch(rpc_endpoint: str, payload: List[dict]):
+_thread_state = threading.local()
+
+
+def run(coroutine):
+    """ Run coroutine on this thread's persistent event loop, so ipc connections outlive a single batch.
+    """
+    loop = getattr(_thread_state, 'loop', None)
+    if loop is None:
+        loop = asyncio.new_event_loop()
+        _thread_state.loop = loop
+    return loop.run_until_complete(coroutine)
+
+
+async def run_batch(endpoint_pool: EndpointPool, payload: List[dict], critical: bool=False):
     tasks = []
 
-    async with ClientSession() as session:
+    # concurrency is capped by the pool's limiter rather than the connector
+    async with ClientSession(timeout=ClientTimeout(total=RPC_TIMEOUT), connector=TCPConnector(limit=0)) as session:
         for job in payload:
-            task = asyncio.ensure_future(async_make_request(session, rpc_endpoint, job['method'], job['params'], job['id']))
+            task = asyncio.ensure_future(async_make_request(session, endpoint_pool, job['method'], job['params'], job['id'], critical))
             tasks.append(task)
 
         return await asyncio.gather(*tasks)
@@ -114,41 +441,235 @@ async def run_batch(rpc_endpoint: str, payload: List[dict]):
 RequestParams = Tuple[HexAddress, HexStr, List[str], Optional[int]]
 ContractCallReturnValue = Union[int, HexAddress, List[Union[int, HexAddress]]]
 
+RPC_STATS = dict(batches=0, calls=0, saved_calls=0, hedged=0, errors=0, rpc_secs=0., decode_secs=0.)
+_decoders = dict()        # (output types, index) -> decoder of raw eth_call results
+_coalescer = dict(block=None, results=dict())   # raw eth_call results keyed by (endpoint, to, data, block)
+
+
+def reset_rpc_stats():
+    RPC_STATS.update(batches=0, calls=0, saved_calls=0, hedged=0, errors=0, rpc_secs=0., decode_secs=0.)
+
+
+def rpc_report() -> str:
+    stats = RPC_STATS
+    return f"{stats['calls']} calls in {stats['batches']} batches, {stats['saved_calls']} coalesced, {stats['hedged']} hedged, {stats['errors']} failed: " \
+           f"{round(stats['rpc_secs'], 3)} secs rpc, {round(stats['decode_secs'], 3)} secs decoding\n{_endpoint_pool.report()}"
+
+
+def new_block(block: BlockNumber):
+    """ Pin eth_calls to block and reuse their results for the rest of it, dropping results of earlier blocks.
+    """
+    if _coalescer['block'] != block:
+        _coalescer.update(block=block, results=dict())
+
+
+def _block_tag() -> str:
+    block = _coalescer['block']
+    return 'latest' if block is None else hex(block)
+
+
+def _get_word_decoder(abi_type: str) -> Optional[Callable[[memoryview], Union[int, bool, bytes, HexAddress]]]:
+    """ Decoder of one 32 byte word of a static abi type, None for dynamic and tuple types.
+    """
+    if '[' in abi_type or '(' in abi_type:
+        return None
+    if abi_type.startswith('uint'):
+        return lambda word: int.from_bytes(word, 'big')
+    if abi_type.startswith('int'):
+        return lambda word: int.from_bytes(word, 'big', signed=True)
+    if abi_type == 'address':
+        # lowercase like eth_abi
+        return lambda word: '0x' + word[12:].hex()
+    if abi_type == 'bool':
+        return lambda word: int.from_bytes(word, 'big') != 0
+    if abi_type.startswith('bytes') and abi_type[5:].isdigit():
+        size = int(abi_type[5:])
+        return lambda word: bytes(word[:size])
+    return None
+
+
+def _compile_decoder(out_types: List[str], index: Optional[int]) -> Callable[[HexStr], ContractCallReturnValue]:
+    word_decoders = [_get_word_decoder(abi_type) for abi_type in out_types]
+    if None in word_decoders:
+        def decode(result: HexStr) -> ContractCallReturnValue:
+            values = decode_abi(out_types, HexBytes(result))
+            value = values if index is None else values[index]
+            return list(value) if type(value) is tuple else value
+        return decode
+
+    size = 32 * len(out_types)
+
+    def words(result: HexStr) -> memoryview:
+        buffer = memoryview(bytes.fromhex(result[2:]))
+        if len(buffer) < size:
+            raise InsufficientDataBytes(f"Tried to read {size} bytes. Only got {len(buffer)} bytes")
+        return buffer
+
+    if index is None:
+        def decode(result: HexStr) -> List[Union[int, bool, bytes, HexAddress]]:
+            buffer = words(result)
+            return [decode_word(buffer[32 * i:32 * (i + 1)]) for i, decode_word in enumerate(word_decoders)]
+    else:
+        position = range(len(out_types))[index]
+        decode_word = word_decoders[position]
+
+        def decode(result: HexStr) -> Union[int, bool, bytes, HexAddress]:
+            return decode_word(words(result)[32 * position:32 * (position + 1)])
+    return decode
+
 
-def batch_request(requests: List[RequestParams], ganache: bool=False) -> List[ContractCallReturnValue]:
+def get_decoder(out_types: List[str], index: Optional[int]=None) -> Callable[[HexStr], ContractCallReturnValue]:
+    """ Decoder of eth_call results returning out_types, applying index like batch_request.
+    Static types are read straight from the result's words, anything dynamic goes through decode_abi.
+    """
+    key = (tuple(out_types), index)
+    decoder = _decoders.get(key)
+    if decoder is None:
+        decoder = _compile_decoder(out_types, index)
+        _decoders.update({key: decoder})
+    return decoder
+
+
+def batch_request(requests: List[RequestParams], ganache: bool=False, state_override: Optional[dict]=None,
+                  allow_errors: bool=False, critical: bool=False) -> List[Union[ContractCallReturnValue, CallError]]:
     # credit to jakublipinski
+    # a call that fails after retries, reverts or returns too little data raises CallError,
+    # or with allow_errors is returned as a CallError in its place so the rest of the batch is kept
+    # state_override maps addresses to replaced account fields, e.g. {address: {'code': runtime_bytecode}}
+    # critical calls, e.g. the per block refresh, are hedged across endpoints, the rest go to the least loaded one
+    rpc_endpoint = _ganache_local_host if ganache else _geth_local_host
+    endpoint_pool = _ganache_pool if ganache else _endpoint_pool
+    override = list() if state_override is None else [state_override]
+    block = _coalescer['block']
+    # identical calls share one request, and once new_block has pinned a block their results are reused for the rest of it
+    keys = [(rpc_endpoint, req[0].lower(), req[1].lower(), block) for req in requests]
+    reusable = block is not None and state_override is None
+    cached = _coalescer['results'] if reusable else dict()
+    pending = list(dict.fromkeys([key for key in keys if key not in cached]))
     payload = [{'method': 'eth_call',
-                'params': [{'to': req[0], 'data': req[1]}, 'latest'], 'id': i}
-               for i, req in enumerate(requests)]
-    responses = asyncio.run(run_batch(_ganache_local_host if ganache else _geth_local_host, payload))
-    results = [response['result'] for response in sorted(responses, key=lambda r: r['id'])]
+                'params': [{'to': key[1], 'data': key[2]}, _block_tag()] + override, 'id': i}
+               for i, key in enumerate(pending)]
+    start = perf_counter()
+    responses = run(run_batch(endpoint_pool, payload, critical)) if payload != list() else list()
+    fetched = {key: response for key, response in zip(pending, sorted(responses, key=lambda r: r['id']))}
+    cached.update({key: response['result'] for key, response in fetched.items() if 'error' not in response.keys()})
+    decode_start = perf_counter()
     decoded_results = list()
-    for req, res in zip(requests, results):
+    for key, req in zip(keys, requests):
+        response = fetched.get(key)
         try:
-            decoded_result = decode_abi(req[2], HexBytes(res))
-            decoded_results.append(decoded_result)
-        except InsufficientDataBytes:
-            print(f"Failed on request: {req}")
-            print(f"Gave result: {res}")
-            raise
-
-    decoded_results = [dres if req[3] is None else dres[req[3]] for req, dres in zip(requests, decoded_results)]
-    list_results = [list(res) if type(res) is tuple else res for res in decoded_results]
-    return list_results
+            if response is not None and 'error' in response.keys():
+                raise CallError(req, response['error'])
+            result = cached[key] if response is None else response['result']
+            try:
+                decoded_results.append(get_decoder(req[2], req[3])(result))
+            except InsufficientDataBytes as e:
+                raise CallError(req, f"{e}, result {result}")
+        except CallError as e:
+            RPC_STATS['errors'] += 1
+            if not allow_errors:
+                raise
+            decoded_results.append(e)
+
+    stop = perf_counter()
+    RPC_STATS['batches'] += 1
+    RPC_STATS['calls'] += len(pending)
+    RPC_STATS['saved_calls'] += len(requests) - len(pending)
+    RPC_STATS['rpc_secs'] += decode_start - start
+    RPC_STATS['decode_secs'] += stop - decode_start
+    return decoded_results
+
+
+StorageRead = Tuple[HexAddress, int]
+
+
+def mapping_slot(key: Union[HexAddress, int], slot: int) -> int:
+    """ Storage slot of key in a solidity mapping declared at slot, keccak256(key . slot).
+    """
+    key = int(key, 16) if type(key) is str else key
+    return int.from_bytes(Web3.keccak(key.to_bytes(32, 'big') + slot.to_bytes(32, 'big')), 'big')
+
+
+def array_slot(slot: int, index: int) -> int:
+    """ Storage slot of element index of a solidity dynamic array or a vyper 0.2 array declared at slot, keccak256(slot) + index.
+    """
+    return int.from_bytes(Web3.keccak(slot.to_bytes(32, 'big')), 'big') + index
+
+
+def unpack(word: int, bits: List[int]) -> List[int]:
+    """ Values packed into one storage word, lowest order bits first.
+    """
+    values = list()
+    for num_bits in bits:
+        values.append(word & ((1 << num_bits) - 1))
+        word >>= num_bits
+    return values
+
+
+def batch_storage_request(reads: List[StorageRead], ganache: bool=False, critical: bool=False) -> List[int]:
+    """ Raw storage words at (address, slot) for every read in a single eth_getStorageAt batch.
+    Raises ValueError if any read fails so callers can fall back to eth_call.
+    """
+    payload = [{'method': 'eth_getStorageAt',
+                'params': [address, hex(slot), _block_tag()], 'id': i}
+               for i, (address, slot) in enumerate(reads)]
+    responses = run(run_batch(_ganache_pool if ganache else _endpoint_pool, payload, critical))
+    responses = sorted(responses, key=lambda r: r['id'])
+    errors = [response['error'] for response in responses if 'error' in response.keys()]
+    if errors != list():
+        raise ValueError(errors[0])
+    return [int(response['result'], 16) for response in responses]
 
 
 def request(to_address: HexAddress, data: HexStr, output_type: str, ganache: bool=False) -> ContractCallReturnValue:
     provider = _ganache_provider if ganache else _http_provider
-    response = provider.make_request('eth_call', [{'to': to_address, 'data': data}, 'latest'])
-    if 'error' in response.keys():
-        raise ValueError
+    block = _coalescer['block']
+    key = (_ganache_local_host if ganache else _geth_local_host, to_address.lower(), data.lower(), block)
+    result = _coalescer['results'].get(key) if block is not None else None
+    if result is not None:
+        RPC_STATS['saved_calls'] += 1
     else:
+        response = provider.make_request('eth_call', [{'to': to_address, 'data': data}, _block_tag()])
+        RPC_STATS['calls'] += 1
+        if 'error' in response.keys():
+            raise ValueError
         result = response['result']
-        value = decode_abi(output_type, HexBytes(result))
-        if len(output_type) == 1:
-            list_result = list(value[0]) if type(value[0]) is tuple else value[0]
-            return list_result
-        return value
+        if block is not None:
+            _coalescer['results'].update({key: result})
+    value = decode_abi(output_type, HexBytes(result))
+    if len(output_type) == 1:
+        list_result = list(value[0]) if type(value[0]) is tuple else value[0]
+        return list_result
+    return value
+
+
+def get_logs(addresses: List[ChecksumAddress], topics: List[HexStr], from_block: BlockNumber, to_block: BlockNumber, ganache: bool=False) -> List[dict]:
+    """ Raw logs emitted by any of addresses with any of topics as topic0, from from_block to to_block inclusive.
+    """
+    provider = _ganache_provider if ganache else _http_provider
+    log_filter = {'fromBlock': hex(from_block), 'toBlock': hex(to_block), 'address': addresses, 'topics': [topics]}
+    response = provider.make_request('eth_getLogs', [log_filter])
+    if 'error' in response.keys():
+        raise ValueError(response['error'])
+    return response['result']
+
+
+def get_logs_chunked(addresses: List[ChecksumAddress], topics: List[HexStr], from_block: BlockNumber, to_block: BlockNumber,
+                     chunk_size: int=100000, ganache: bool=False) -> List[dict]:
+    """ get_logs over a long block range in chunks, halving the chunk whenever the node refuses one, e.g. for too many results.
+    """
+    logs = list()
+    start = from_block
+    while start <= to_block:
+        end = min(start + chunk_size - 1, to_block)
+        try:
+            logs.extend(get_logs(addresses, topics, start, end, ganache))
+            start = end + 1
+        except ValueError:
+            if chunk_size == 1:
+                raise
+            chunk_size = max(chunk_size // 2, 1)
+    return logs
 
 
 def latest_block(ganache: bool=False) -> BlockNumber:
@@ -0,0 +1,76 @@
+import numpy
+
+from typing import Dict, Hashable, List, Tuple
+
+
+class PoolRegistry:
+    """ Integer ids for a graph's pools, with the ids of each pool type kept in one contiguous list and the pools of every edge
+    in a flat index array, so the per block refresh and the search walk arrays instead of filtering dicts and sets.
+    """
+
+    def __init__(self):
+        self.pools = list()                 # pool id -> pool
+        self.ids = dict()                   # pool address -> pool id
+        self.token_pairs = list()           # edge index -> (in_token, out_token)
+        self._type_ids = dict()             # pool type -> ids of its pools in registration order
+        self._edge_ids = list()             # edge index -> pool ids, while edges are still being added
+        self._edge_offsets = None           # edge index -> start of its pool ids in _edge_pool_ids once frozen
+        self._edge_pool_ids = None
+
+    def __len__(self) -> int:
+        return len(self.pools)
+
+    def register(self, pool) -> int:
+        if pool.address not in self.ids:
+            self.ids.update({pool.address: len(self.pools)})
+            self._type_ids.setdefault(type(pool), list()).append(len(self.pools))
+            self.pools.append(pool)
+        return self.ids[pool.address]
+
+    def add_to_edge(self, edge_index: int, pool, token_pair: Tuple[Hashable, Hashable]):
+        pool_id = self.register(pool)
+        if self._edge_ids is None:
+            self._thaw()
+        while len(self._edge_ids) <= edge_index:
+            self._edge_ids.append(list())
+            self.token_pairs.append(None)
+        if pool_id not in self._edge_ids[edge_index]:
+            self._edge_ids[edge_index].append(pool_id)
+        self.token_pairs[edge_index] = token_pair
+
+    def freeze(self):
+        """ Pack the pool ids of every edge into one int32 array indexed by per edge offsets.
+        """
+        if self._edge_ids is None:
+            return
+        lengths = [len(pool_ids) for pool_ids in self._edge_ids]
+        self._edge_offsets = numpy.zeros(len(lengths) + 1, dtype=numpy.int64)
+        numpy.cumsum(lengths, out=self._edge_offsets[1:])
+        self._edge_pool_ids = numpy.fromiter([pool_id for pool_ids in self._edge_ids for pool_id in pool_ids],
+                                             dtype=numpy.int32, count=int(self._edge_offsets[-1]))
+        self._edge_ids = None
+
+    def _thaw(self):
+        offsets = self._edge_offsets.tolist()
+        pool_ids = self._edge_pool_ids.tolist()
+        self._edge_ids = [pool_ids[start:stop] for start, stop in zip(offsets, offsets[1:])]
+        self._edge_offsets = None
+        self._edge_pool_ids = None
+
+    def edge_ids(self, edge_index: int) -> List[int]:
+        if self._edge_ids is not None:
+            return list(self._edge_ids[edge_index])
+        return self._edge_pool_ids[self._edge_offsets[edge_index]:self._edge_offsets[edge_index + 1]].tolist()
+
+    def edge_pools(self, edge_index: int) -> List:
+        pools = self.pools
+        return [pools[pool_id] for pool_id in self.edge_ids(edge_index)]
+
+    def of_type(self, *pool_types: type) -> List:
+        """ Pools of the given types, each type's in registration order.
+        """
+        pools = self.pools
+        return [pools[pool_id] for pool_type in pool_types for pool_id in self._type_ids.get(pool_type, list())]
+
+    def counts(self) -> Dict[str, int]:
+        return {pool_type.__name__: len(pool_ids) for pool_type, pool_ids in self._type_ids.items()}
@@ -0,0 +1,104 @@
+from bisect import bisect_left
+from typing import Callable, Dict, Hashable
+
+
+class ResponseCurve:
+    """ Exact quotes of one (pool, token pair) sampled on a log-spaced in_amount grid, linearly interpolated in between.
+    Out amounts are forced non-decreasing, so the interpolant is monotone.
+    """
+
+    def __init__(self, quote: Callable[[int], int], max_in_amount: int, num_points: int=32, span: int=10**9):
+        self._quote = quote
+        self._ratio = span ** (1 / (num_points - 1))
+        min_in_amount = max(max_in_amount // span, 1)
+        self.in_amounts = list()
+        self.out_amounts = list()
+        self._cliff = None          # smallest sampled in_amount the pool refuses, e.g. over balancer's max in ratio
+        self._append(min_in_amount, max_in_amount)
+
+    def _append(self, in_amount: float, max_in_amount: int):
+        last_in_amount = self.in_amounts[-1] if self.in_amounts else 0
+        last_out_amount = self.out_amounts[-1] if self.out_amounts else 0
+        while last_in_amount < max_in_amount and self._cliff is None:
+            in_amount = min(max(int(in_amount), last_in_amount + 1), max_in_amount)
+            out_amount = self._quote(in_amount)
+            if out_amount == 0 and last_out_amount > 0:
+                self._cliff = in_amount
+                break
+            last_out_amount = max(out_amount, last_out_amount)
+            last_in_amount = in_amount
+            self.in_amounts.append(in_amount)
+            self.out_amounts.append(last_out_amount)
+            in_amount *= self._ratio
+
+    @property
+    def max_in_amount(self) -> int:
+        return self.in_amounts[-1]
+
+    @property
+    def max_out_amount(self) -> int:
+        return self.out_amounts[-1]
+
+    def extend(self, max_in_amount: int):
+        """ Sample further points on the same grid spacing until max_in_amount is covered.
+        """
+        self._append(self.max_in_amount * self._ratio, max_in_amount)
+
+    def __call__(self, in_amount: int) -> int:
+        if in_amount <= 0:
+            return 0
+        if self._cliff is not None and in_amount >= self._cliff:
+            return 0
+        i = bisect_left(self.in_amounts, in_amount)
+        if i == len(self.in_amounts):
+            return self.out_amounts[-1]
+        x1, y1 = self.in_amounts[i], self.out_amounts[i]
+        if x1 == in_amount:
+            return y1
+        x0, y0 = (self.in_amounts[i - 1], self.out_amounts[i - 1]) if i > 0 else (0, 0)
+        return y0 + (y1 - y0) * (in_amount - x0) // (x1 - x0)
+
+
+class ResponseCurveLayer:
+    """ Per-block response curves for pools whose exact quotes are expensive.
+    Curves are sampled the first time a (pool, token pair) is needed in a block and verified against exact quotes at chosen sizes.
+    """
+
+    def __init__(self, num_points: int=32):
+        self._num_points = num_points
+        self._curves = dict()
+        self._errors = list()
+
+    def new_block(self):
+        self._curves = dict()
+        self._errors = list()
+
+    def __len__(self) -> int:
+        return len(self._curves)
+
+    def get_curve(self, key: Hashable, quote: Callable[[int], int], max_in_amount: int) -> ResponseCurve:
+        curve = self._curves.get(key)
+        if curve is None:
+            curve = ResponseCurve(quote, max_in_amount, self._num_points)
+            self._curves.update({key: curve})
+        elif curve.max_in_amount < max_in_amount:
+            curve.extend(max_in_amount)
+        return curve
+
+    def record(self, key: Hashable, in_amount: int, exact_out_amount: int):
+        """ Record the relative interpolation error of the curve at key against an exact quote.
+        """
+        curve = self._curves.get(key)
+        if curve is None or exact_out_amount <= 0:
+            return
+        self._errors.append(abs(curve(in_amount) - exact_out_amount) / exact_out_amount)
+
+    def errors(self) -> Dict[str, float]:
+        errors = self._errors
+        if errors == list():
+            return dict(verified=0, mean=0., max=0.)
+        return dict(verified=len(errors), mean=sum(errors) / len(errors), max=max(errors))
+
+    def report(self) -> str:
+        errors = self.errors()
+        return f"{len(self)} response curves, interpolation error over {errors['verified']} exact quotes: mean {errors['mean']:.2e} max {errors['max']:.2e}"
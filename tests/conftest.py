@@ -0,0 +1,8 @@
+import os
+import sys
+
+# the bot's modules are imported from the repository root, as main.py and bench.py import them
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# config.ini and the brownie project are read relative to the working directory
+os.chdir(ROOT)
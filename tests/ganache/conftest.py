@@ -0,0 +1,14 @@
+import pytest
+
+
+@pytest.fixture(scope='session')
+def main():
+    """ main connected to the local mainnet fork, as in test mode. Checks are skipped without brownie or a running fork.
+    """
+    for module in ['brownie', 'graph_tool', 'web3']:
+        pytest.importorskip(module)
+    try:
+        import main
+    except (ConnectionError, OSError) as e:
+        pytest.skip(f"no ganache fork: {e}")
+    return main
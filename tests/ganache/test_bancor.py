@@ -0,0 +1,41 @@
+import pytest
+
+
+def _buy_bnt(main, token_graph, weth_amount: int):
+    bnt = main.TRADE_SET['BNT']
+    pairs = [pool for pool in token_graph._registry.of_type(main.UniswapV2Pair)
+             if set(pool._tokens) == {main.WETH, bnt}]
+    if pairs == list():
+        pytest.skip("no uniswap v2 weth/bnt pair to fund the faucet with bnt")
+    token_pair = (main.WETH, bnt)
+    pairs[0].test_swap(weth_amount, pairs[0].get_out_amount(weth_amount, token_pair), token_pair)
+
+
+@pytest.mark.parametrize('is_gte_v28', [True, False])
+def test_convert_by_path_matches_quote(main, is_gte_v28):
+    """ A swap through BANCOR_NETWORK.convertByPath pays exactly get_out_amount, i.e. convert and deduct_fee,
+    on v28 converters and on older ones charging the fee through getFinalAmount.
+    """
+    token_graph = main.TokenGraph(main.__faucet__)
+    main.UniswapV2(token_graph)
+    main.Bancor(token_graph)
+    pools = [pool for pool in token_graph._registry.of_type(main.BancorPool)
+             if pool._is_gte_v28 == is_gte_v28 and main.ETH not in pool.tokens]
+    if pools == list():
+        pytest.skip(f"no {'v28' if is_gte_v28 else 'pre v28'} converter in the trade set")
+    bnt = main.TRADE_SET['BNT']
+    with main.RevertTransactions():
+        _buy_bnt(main, token_graph, 10 * main.WETH_SCALE)
+        token_graph._cache_pool_params(main.chain.height, ganache=True)
+        bnt_balance = main.interface.IERC20(bnt).balanceOf(main.__faucet__)
+        for pool in pools[:3]:
+            token = pool.tokens[0] if pool.tokens[1] == bnt else pool.tokens[1]
+            token_pair = (bnt, token)
+            in_amount = min(bnt_balance // 4, pool.get_reserves(token_pair)[0] // 100)
+            out_amount = pool.get_out_amount(in_amount, token_pair)
+            assert out_amount > 0
+            token_contract = main.interface.IERC20(token)
+            balance_before = token_contract.balanceOf(main.__faucet__)
+            pool.test_swap(in_amount, out_amount, token_pair)
+            received = token_contract.balanceOf(main.__faucet__) - balance_before
+            assert received == out_amount, f"{pool.address}: received {received}, quoted {out_amount}"
@@ -0,0 +1,56 @@
+import pytest
+
+TOKEN = '0x' + '11' * 20
+
+
+def _candidate(main, in_amount, profit, pools, token_pairs):
+    ordered_token_pairs = [tp if int(tp[0], 16) < int(tp[1], 16) else (tp[1], tp[0]) for tp in token_pairs]
+    return {
+        'profit_after_fees': profit,
+        'estimated_gas_cost': 0,
+        'swap_ids': {(pool.address, token_pair) for pool, token_pair in zip(pools, ordered_token_pairs)},
+        'route': (pools, token_pairs),
+        'arb_data': {'in_amount': in_amount, 'pools': [pool.address for pool in pools], 'profit': profit}
+    }
+
+
+@pytest.fixture
+def cheap_and_dear_pairs(main):
+    """ Token bought at 2 per weth on one pair and sold at 1 per weth on the other.
+    """
+    tokens = (main.WETH, TOKEN) if int(main.WETH, 16) < int(TOKEN, 16) else (TOKEN, main.WETH)
+    cheap = main.UniswapV2Pair('0x' + '01' * 20, tokens)
+    dear = main.UniswapV2Pair('0x' + '02' * 20, tokens)
+    weth_index = tokens.index(main.WETH)
+    cheap.set_state([1000 * main.WETH_SCALE, 2000 * main.WETH_SCALE] if weth_index == 0 else [2000 * main.WETH_SCALE, 1000 * main.WETH_SCALE])
+    dear.set_state([1000 * main.WETH_SCALE] * 2)
+    return cheap, dear
+
+
+@pytest.mark.parametrize('fails', [False, True])
+def test_pack_bundle_restores_pool_states(main, cheap_and_dear_pairs, monkeypatch, fails):
+    """ The conflicting arbitrage is re-priced on the pools moved by the one picked ahead of it,
+    and the pools are back to their states afterwards, whether re-pricing succeeds or raises.
+    """
+    token_graph = main.TokenGraph(main.__faucet__)
+    pools = list(cheap_and_dear_pairs)
+    token_pairs = [(main.WETH, TOKEN), (TOKEN, main.WETH)]
+    states = [pool.get_state() for pool in pools]
+    repriced_on = list()
+
+    def price_arbitrage(in_amount, profit, pools, token_pairs, *args):
+        repriced_on.append([pool.get_state() for pool in pools])
+        if fails:
+            raise Exception("estimate failed")
+        return _candidate(main, in_amount, profit, pools, token_pairs)
+
+    monkeypatch.setattr(token_graph, '_price_arbitrage', price_arbitrage)
+    candidates = [_candidate(main, 100 * main.WETH_SCALE, 10, pools, token_pairs),
+                  _candidate(main, 50 * main.WETH_SCALE, 5, pools, token_pairs)]
+    bundle = token_graph._pack_bundle(candidates, 1000 * main.WETH_SCALE, None, {'fee': 0}, 0)
+
+    assert len(repriced_on) == 1
+    assert repriced_on[0] != states
+    assert bundle[0] is candidates[0]
+    assert len(bundle) == (1 if fails else 2)
+    assert [pool.get_state() for pool in pools] == states
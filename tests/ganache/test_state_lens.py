@@ -0,0 +1,56 @@
+import pytest
+
+
+@pytest.fixture(scope='module')
+def lens_graph(main):
+    """ Uniswap v2 and balancer pools, the deployed PoolStateLens and a contract that reverts on every pool call.
+    """
+    token_graph = main.TokenGraph(main.__faucet__)
+    main.UniswapV2(token_graph)
+    main.Balancer(token_graph)
+    lens_address, _ = token_graph._get_state_lens(ganache=True)
+    reverting = main.TestUniswapV3FlashCallback.deploy(main.from_faucet(0)).address
+    return token_graph, main.PoolStateLens.at(lens_address), reverting
+
+
+def test_uniswapv2_reserves_match_get_reserves(main, lens_graph):
+    token_graph, lens, reverting = lens_graph
+    unipairs = token_graph._registry.of_type(main.UniswapV2Pair)[:5]
+    words, ok = lens.uniswapV2Reserves([pool.address for pool in unipairs] + [reverting])
+    assert list(ok) == [True] * len(unipairs) + [False]
+    assert words[-1] == 0
+    for pool, word in zip(unipairs, words):
+        reserve0, reserve1, timestamp = main.geth_client.request(*pool.get_param_calls()[:-1], True)
+        assert word == reserve0 | reserve1 << 112 | timestamp << 224, pool.address
+
+
+def test_balancer_states_match_balances_and_weights(main, lens_graph):
+    token_graph, lens, reverting = lens_graph
+    b_pools = token_graph._registry.of_type(main.BalancerPool)[:3]
+    tokens = [token for pool in b_pools for token in pool.tokens] + [main.WETH, main.TRADE_SET['BNT']]
+    words, ok = lens.balancerStates([pool.address for pool in b_pools] + [reverting], [pool.num_tokens for pool in b_pools] + [2], tokens)
+    assert list(ok) == [True] * len(b_pools) + [False]
+    assert list(words[-4:]) == [0, 0, 0, 0]
+    offset = 0
+    for pool in b_pools:
+        num_words = 2 * pool.num_tokens
+        # balances of every token, then their denormalized weights, as the pool's own calls return them
+        assert list(words[offset:offset + num_words]) == main.geth_client.batch_request(pool.get_param_calls(), True), pool.address
+        offset += num_words
+
+
+def test_reverting_pool_is_stale(main, lens_graph):
+    """ A pool reverting inside the lens is marked stale and keeps its state, the others get their eth_call state.
+    """
+    token_graph, _, reverting = lens_graph
+    bad_pair = main.UniswapV2Pair(reverting, (main.WETH, main.TRADE_SET['BNT']))
+    bad_pair.set_params(1, 2)
+    v1, v2 = token_graph.update_vertex(main.WETH), token_graph.update_vertex(main.TRADE_SET['BNT'])
+    token_graph.update_edge(v1, v2, bad_pair)
+    token_graph._stale_pools = set()
+    refreshed = token_graph._cache_pool_lens(ganache=True)
+    assert reverting in refreshed and reverting in token_graph._stale_pools
+    assert bad_pair.get_state() == [1, 2]
+    for pool in token_graph._registry.of_type(main.UniswapV2Pair)[:5]:
+        if pool.address != reverting:
+            assert pool.get_state() == list(main.geth_client.request(*pool.get_param_calls()[:-1], True)[:2])
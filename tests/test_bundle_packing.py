@@ -0,0 +1,75 @@
+import random
+import pytest
+
+from bundle_packing import BundlePacker
+
+
+def _random_case(rng: random.Random, num_candidates: int, num_swaps: int):
+    weights = [rng.randint(-5, 20) for _ in range(num_candidates)]
+    swap_ids = [set(rng.sample(range(num_swaps), rng.randint(1, min(num_swaps, 3)))) for _ in range(num_candidates)]
+    return weights, swap_ids
+
+
+def _conflict_free(picked, swap_ids) -> bool:
+    return all(swap_ids[i].isdisjoint(swap_ids[j]) for i in picked for j in picked if i < j)
+
+
+def _brute_force(weights, swap_ids) -> int:
+    best = 0
+    for subset in range(1 << len(weights)):
+        picked = [i for i in range(len(weights)) if subset >> i & 1]
+        if _conflict_free(picked, swap_ids):
+            best = max(best, sum([weights[i] for i in picked]))
+    return best
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_exact_matches_brute_force(seed):
+    rng = random.Random(seed)
+    packer = BundlePacker()
+    for _ in range(100):
+        weights, swap_ids = _random_case(rng, rng.randint(0, 10), rng.randint(2, 8))
+        picked = packer.pack(weights, swap_ids)
+        assert _conflict_free(picked, swap_ids)
+        assert all(weights[i] > 0 for i in picked)
+        assert picked == sorted(picked, key=lambda i: -weights[i])
+        assert sum([weights[i] for i in picked]) == _brute_force(weights, swap_ids)
+        assert packer.report().endswith(", 0 packed greedily")
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_greedy_past_max_exact(seed):
+    rng = random.Random(seed)
+    packer = BundlePacker(max_exact=2)
+    for _ in range(100):
+        weights, swap_ids = _random_case(rng, rng.randint(3, 10), rng.randint(2, 5))
+        picked = packer.pack(weights, swap_ids)
+        assert _conflict_free(picked, swap_ids)
+        assert all(weights[i] > 0 for i in picked)
+        assert sum([weights[i] for i in picked]) <= _brute_force(weights, swap_ids)
+        # no candidate left out outweighs the picked candidates it conflicts with, which also makes the packing maximal
+        for i in set(range(len(weights))) - set(picked):
+            displaced = [j for j in picked if not swap_ids[i].isdisjoint(swap_ids[j])]
+            assert weights[i] <= sum([weights[j] for j in displaced])
+
+
+def test_greedy_stops_at_a_local_optimum():
+    # heaviest first picks 0, and neither 1 nor 2 alone outweighs it, though together they do
+    weights = [10, 6, 6]
+    swap_ids = [{'a', 'b'}, {'a'}, {'b'}]
+    assert BundlePacker(max_exact=0).pack(weights, swap_ids) == [0]
+    assert sorted(BundlePacker().pack(weights, swap_ids)) == [1, 2]
+
+
+def test_components_joined_through_non_positive_candidates():
+    # 1 and 3 conflict with their neighbours but can't be picked, so 0, 2 and 4 all fit in one component
+    weights = [5, 0, 7, -3, 4]
+    swap_ids = [{'a'}, {'a', 'b'}, {'b', 'c'}, {'c', 'd'}, {'d'}]
+    packer = BundlePacker()
+    assert packer.pack(weights, swap_ids) == [2, 0, 4]
+    assert packer.report() == "bundle packing: 5 candidates in 1 conflict components, 0 packed greedily"
+    # the joined component has 3 pickable members, past a max_exact of 2
+    packer = BundlePacker(max_exact=2)
+    assert packer.pack(weights, swap_ids) == [2, 0, 4]
+    assert packer.report() == "bundle packing: 5 candidates in 1 conflict components, 1 packed greedily"
+    assert packer.pack([0, 0, -1], [{'a'}, {'a'}, {'b'}]) == list()
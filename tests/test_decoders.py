@@ -0,0 +1,68 @@
+import random
+import pytest
+
+for module in ['eth_abi', 'web3', 'aiohttp']:
+    pytest.importorskip(module)
+
+import geth_client
+
+from eth_abi import decode_abi, encode_abi
+from eth_abi.exceptions import InsufficientDataBytes, NonEmptyPaddingBytes
+
+
+def _random_value(rng: random.Random, abi_type: str):
+    if abi_type.startswith('uint'):
+        return rng.randrange(2 ** int(abi_type[4:] or 256))
+    if abi_type.startswith('int'):
+        bits = int(abi_type[3:] or 256)
+        return rng.randrange(-2 ** (bits - 1), 2 ** (bits - 1))
+    if abi_type == 'address':
+        return '0x' + bytes([rng.randrange(256) for _ in range(20)]).hex()
+    if abi_type == 'bool':
+        return rng.random() < 0.5
+    return bytes([rng.randrange(256) for _ in range(int(abi_type[5:]))])
+
+
+def _reference(out_types, index, result):
+    values = decode_abi(out_types, bytes.fromhex(result[2:]))
+    value = values if index is None else values[index]
+    return list(value) if type(value) is tuple else value
+
+
+STATIC_TYPES = ['uint256', 'uint112', 'uint32', 'uint8', 'int256', 'int24', 'int128', 'address', 'bool', 'bytes32', 'bytes4', 'bytes1']
+
+
+@pytest.mark.parametrize('index', [None, 0, 1, -1, -2])
+def test_compiled_decoders_match_decode_abi(index):
+    rng = random.Random(index)
+    for _ in range(200):
+        out_types = rng.sample(STATIC_TYPES, rng.randint(2, 5))
+        values = [_random_value(rng, abi_type) for abi_type in out_types]
+        result = '0x' + encode_abi(out_types, values).hex()
+        assert geth_client.get_decoder(out_types, index)(result) == _reference(out_types, index, result), out_types
+
+
+def test_dynamic_types_go_through_decode_abi():
+    out_types = ['uint256[]', 'bool[]']
+    result = '0x' + encode_abi(out_types, [[1, 2, 3], [True, False, True]]).hex()
+    assert geth_client.get_decoder(out_types, None)(result) == _reference(out_types, None, result)
+    assert geth_client.get_decoder(['uint256[]'], -1)('0x' + encode_abi(['uint256[]'], [[4, 5]]).hex()) == [4, 5]
+
+
+@pytest.mark.parametrize('index', [None, -1])
+def test_short_results_raise_insufficient_data(index):
+    out_types = ['uint112', 'uint112', 'uint32']
+    result = '0x' + encode_abi(out_types, [1, 2, 3]).hex()[:-2]
+    with pytest.raises(InsufficientDataBytes):
+        _reference(out_types, index, result)
+    with pytest.raises(InsufficientDataBytes):
+        geth_client.get_decoder(out_types, index)(result)
+
+
+def test_bool_skips_the_padding_check():
+    """ The one intended difference: any non-zero word is True, where decode_abi rejects a bool word other than 0 or 1.
+    """
+    result = '0x' + (2).to_bytes(32, 'big').hex()
+    with pytest.raises(NonEmptyPaddingBytes):
+        _reference(['bool'], -1, result)
+    assert geth_client.get_decoder(['bool'], -1)(result) is True
@@ -0,0 +1,60 @@
+from token_universe import TokenUniverse
+
+
+def test_select_keeps_pinned_and_best_scoring():
+    universe = TokenUniverse(['weth'], size=3, max_circuits=10)
+    added, removed = universe.select({'a': 5., 'b': 30., 'c': 20., 'weth': 0.})
+    assert universe.tokens == {'weth', 'b', 'c'}
+    assert (added, removed) == ({'b', 'c'}, set())
+
+
+def test_select_diffs_against_previous_selection():
+    universe = TokenUniverse(['weth'], size=3, max_circuits=10)
+    universe.select({'a': 5., 'b': 30., 'c': 20.})
+    added, removed = universe.select({'a': 50., 'b': 30., 'c': 20.})
+    assert universe.tokens == {'weth', 'a', 'b'}
+    assert (added, removed) == ({'a'}, {'c'})
+    assert universe.select({'a': 50., 'b': 30., 'c': 20.}) == (set(), set())
+
+
+def test_activity_counts_towards_the_score():
+    universe = TokenUniverse(['weth'], size=2, max_circuits=10, activity_weight=100., half_life=1.)
+    universe.record_activity({'a': 1.})
+    universe.select({'a': 10., 'b': 100.})
+    assert universe.tokens == {'weth', 'a'}
+    # one half life later the average volume of a halved, worth 50 against the 100 of b's liquidity
+    universe.record_activity(dict())
+    assert universe.activity == {'a': 0.5}
+    universe.select({'a': 10., 'b': 100.})
+    assert universe.tokens == {'weth', 'b'}
+
+
+def test_excluded_tokens_are_never_ranked_again():
+    universe = TokenUniverse(['weth'], size=3, max_circuits=10)
+    universe.select({'a': 5., 'b': 30., 'c': 20.})
+    universe.exclude({'b', 'weth'})
+    assert universe.tokens == {'weth', 'c'}
+    added, removed = universe.select({'a': 5., 'b': 30., 'c': 20.})
+    assert universe.tokens == {'weth', 'a', 'c'}
+    assert (added, removed) == ({'a'}, set())
+    assert 'b' not in universe.scores({'b': 30.})
+
+
+def test_budget_keeps_circuits_with_the_best_worst_rank():
+    universe = TokenUniverse(['weth'], size=4, max_circuits=3)
+    universe.select({'a': 40., 'b': 30., 'c': 20., 'd': 10.})
+    # ranks: weth -1, a 0, b 1, c 2, d 3; tokens never scored rank after every ranked token
+    circuits = [['weth', 'd', 'weth'],      # worst rank 3
+                ['weth', 'a', 'b'],         # 1
+                ['weth', 'x', 'a'],         # unranked
+                ['weth', 'a', 'weth'],      # 0
+                ['weth', 'c', 'a']]         # 2
+    assert universe.budget(circuits) == [1, 3, 4]
+    assert TokenUniverse(['weth'], size=4, max_circuits=10).budget(circuits) == [0, 1, 2, 3, 4]
+
+
+def test_budget_orders_unranked_tokens_last():
+    universe = TokenUniverse(['weth'], size=2, max_circuits=2)
+    universe.select({'a': 40., 'b': 30.})
+    # b is ranked though not selected, so it still beats a token that was never scored
+    assert universe.budget([['weth', 'x'], ['weth', 'b'], ['weth', 'a']]) == [1, 2]
@@ -0,0 +1,59 @@
+from typing import Dict, Hashable, Iterable, List, Set, Tuple
+
+
+class TokenUniverse:
+    """ Tokens worth searching, ranked by the weth they can be traded against plus their recent weth valued volume.
+    The top size tokens are kept, and circuits through them are cut off at max_circuits, cheapest ranked tokens first.
+    """
+
+    def __init__(self, pinned: Iterable[Hashable], size: int, max_circuits: int, activity_weight: float=100., half_life: float=300.):
+        self._pinned = set(pinned)              # always in the universe, e.g. weth
+        self._size = size
+        self._max_circuits = max_circuits
+        self._activity_weight = activity_weight   # blocks of volume worth as much as the same amount of liquidity
+        self._decay = 0.5 ** (1 / half_life)      # per block decay of the volume average, half_life in blocks
+        self.tokens = set(self._pinned)
+        self.activity = dict()                    # token -> per block weth volume, exponentially averaged, replaced rather than mutated
+        self._excluded = set()                    # tokens that can't be traded, e.g. without decimals()
+        self._ranks = dict()
+
+    def record_activity(self, volumes: Dict[Hashable, float]):
+        """ Fold one block of weth valued volume per token into the average.
+        """
+        decay, activity = self._decay, self.activity
+        self.activity = {token: decay * activity.get(token, 0.) + volumes.get(token, 0.) for token in set(activity.keys()) | set(volumes.keys())}
+
+    def exclude(self, tokens: Set[Hashable]):
+        """ Drop tokens from the universe and never rank them again.
+        """
+        self._excluded |= tokens - self._pinned
+        self.tokens -= self._excluded
+
+    def scores(self, weth_liquidity: Dict[Hashable, float]) -> Dict[Hashable, float]:
+        activity = self.activity
+        tokens = (set(weth_liquidity.keys()) | set(activity.keys())) - self._excluded
+        return {token: weth_liquidity.get(token, 0.) + self._activity_weight * activity.get(token, 0.) for token in tokens}
+
+    def select(self, weth_liquidity: Dict[Hashable, float]) -> Tuple[Set[Hashable], Set[Hashable]]:
+        """ Rank every scored token and keep the pinned tokens plus the best scoring ones up to size.
+        Returns the (added, removed) tokens relative to the previous selection.
+        """
+        scores = self.scores(weth_liquidity)
+        ranked = sorted([token for token in scores.keys() if token not in self._pinned], key=lambda token: -scores[token])
+        tokens = self._pinned | set(ranked[:max(self._size - len(self._pinned), 0)])
+        self._ranks = {token: rank for rank, token in enumerate(ranked)}
+        self._ranks.update({token: -1 for token in self._pinned})
+        added, removed = tokens - self.tokens, self.tokens - tokens
+        self.tokens = tokens
+        return added, removed
+
+    def budget(self, circuit_tokens: List[Iterable[Hashable]]) -> List[int]:
+        """ Indices of the circuits kept within max_circuits, preferring circuits whose worst ranked token ranks best.
+        """
+        unranked = len(self._ranks)
+        worst_ranks = [max([self._ranks.get(token, unranked) for token in tokens]) for tokens in circuit_tokens]
+        kept = sorted(range(len(circuit_tokens)), key=lambda i: worst_ranks[i])[:self._max_circuits]
+        return sorted(kept)
+
+    def report(self, added: Set[Hashable], removed: Set[Hashable]) -> str:
+        return f"token universe of {len(self.tokens)} tokens, +{len(added)} -{len(removed)}"